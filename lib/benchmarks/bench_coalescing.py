@@ -0,0 +1,106 @@
+"""Event throughput with and without message coalescing
+
+Starts the fake Home Assistant in a separate process so the
+reported CPU time is the client's alone, then has it fire a
+storm of state_changed events at hass_ae.async_main, once with
+coalesce_messages negotiated and once without.
+
+    python -m benchmarks.bench_coalescing [--events N]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import subprocess
+import sys
+import time
+
+import websockets
+
+import hass_ae
+
+
+async def storm(port, count, entities):
+    """Trigger a storm from a separate control connection"""
+    async with websockets.connect(f'ws://localhost:{port}/api/websocket') as socket:
+        await socket.recv()
+        await socket.send(json.dumps({'type': 'auth', 'access_token': 'fake-token'}))
+        await socket.recv()
+        await socket.send(json.dumps({
+            'id': 1, 'type': 'fake/storm', 'count': count, 'entities': entities}))
+        await socket.recv()
+
+
+async def measure(port, count, entities, coalesce_messages):
+    done = asyncio.Event()
+    context = {}
+
+    async def setup(client, state_manager, registry, **kwargs):
+        context['ws'] = client.ws
+        context['queue'] = client.queue
+
+        async def _done(value):
+            done.set()
+
+        await state_manager.subscribe('sensor.storm_done', _done)
+        context['ready'] = True
+
+    main = asyncio.create_task(hass_ae.async_main(
+        host='localhost',
+        port=port,
+        access_token='fake-token',
+        async_fn=setup,
+        queue_overflow='block',
+        coalesce_messages=coalesce_messages
+    ))
+    while 'ready' not in context:
+        await asyncio.sleep(0.01)
+
+    ws = context['ws']
+    frames, messages = ws.frames_received, ws.messages_received
+    wall, cpu = time.perf_counter(), time.process_time()
+
+    asyncio.create_task(storm(port, count, entities))
+    await done.wait()
+
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    frames, messages = ws.frames_received - frames, ws.messages_received - messages
+
+    main.cancel()
+    return {
+        'coalesce_messages': coalesce_messages,
+        'messages': messages,
+        'frames': frames,
+        'seconds': wall,
+        'messages_per_second': messages / wall,
+        'frames_per_second': frames / wall,
+        'cpu_seconds': cpu,
+        'cpu_us_per_message': cpu / messages * 1e6,
+        'dropped': context['queue'].dropped,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--entities', type=int, default=100)
+    args = parser.parse_args()
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.fake_hass', '--port', '0',
+         '--entities', str(args.entities)],
+        stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline().split()[-1])
+        logging.disable(logging.CRITICAL)
+        for coalesce_messages in (False, True):
+            result = asyncio.run(measure(port, args.events, args.entities, coalesce_messages))
+            print(' '.join(f'{k}={v:.2f}' if isinstance(v, float) else f'{k}={v}'
+                           for k, v in result.items()))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Switch press to light command latency
+
+Runs hass_ae.async_main against a local fake Home Assistant
+and measures the time from a deconz switch press leaving the
+server until the resulting light.turn_on arrives back at it.
+The switch handler mirrors the ones in src/automation.py: one
+awaited service call before the light is turned on.
+
+    python -m benchmarks.bench_latency [--presses N]
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+import hass_ae
+from hass_ae.components import TFSwitch, Light, InputBoolean
+from hass_ae.handlers import TFSwitchHandler
+from benchmarks.fake_hass import FakeHomeAssistant, make_state
+
+
+class PressHandler(TFSwitchHandler):
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    async def on(self):
+        await self.registry.get(InputBoolean, 'is_home').turn_on()
+        await self.registry.get(Light, 'entry').turn_on()
+
+
+async def setup(client, state_manager, registry, **kwargs):
+    registry.register([
+        TFSwitch(
+            identity='sw_tf_1',
+            alias='entry',
+            client=client,
+            handler=PressHandler(registry)
+        ),
+        InputBoolean(
+            identity='ib_is_home',
+            alias='is_home',
+            client=client,
+            state_manager=state_manager
+        ),
+        Light(
+            identity='l_tf_1',
+            alias='entry',
+            client=client,
+            state_manager=state_manager
+        ),
+    ])
+    await registry.subscribe_all()
+
+
+async def measure(presses):
+    server = await FakeHomeAssistant(states=[
+        make_state('input_boolean.ib_is_home'),
+        make_state('light.l_tf_1'),
+    ]).start()
+
+    main = asyncio.create_task(hass_ae.async_main(
+        host='localhost',
+        port=server.port,
+        access_token=server.access_token,
+        async_fn=setup
+    ))
+
+    while 'deconz_event' not in server.subscriptions:
+        await asyncio.sleep(0.01)
+
+    samples = []
+    for _ in range(presses):
+        start = time.perf_counter()
+        await server.press('sw_tf_1')
+        received = await server.wait_for_service_call('light', 'turn_on', 'light.l_tf_1')
+        samples.append((received - start) * 1000)
+
+    # let the last handler see its result before tearing down
+    await asyncio.sleep(0.2)
+    logging.disable(logging.CRITICAL)
+    main.cancel()
+    await server.stop()
+    return samples
+
+
+def report(samples):
+    samples = sorted(samples)
+    print(f'presses: {len(samples)}')
+    print(f'median:  {statistics.median(samples):.2f} ms')
+    print(f'p95:     {samples[int(len(samples) * 0.95) - 1]:.2f} ms')
+    print(f'max:     {samples[-1]:.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--presses', type=int, default=50)
+    args = parser.parse_args()
+    report(asyncio.run(measure(args.presses)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Memory and read cost of the StateManager state store
+
+Decodes a synthetic get_states payload for N entities and
+compares what each store retains once the payload is gone:
+
+    strings  - entity_id -> state string (the original store)
+    raw      - entity_id -> full decoded state dict
+    records  - entity_id -> State record (StateManager)
+
+    python -m benchmarks.bench_state_memory [--entities N]
+"""
+
+import argparse
+import gc
+import json
+import random
+import timeit
+import tracemalloc
+
+from hass_ae.client import StateManager, TRACKED_ATTRIBUTES
+
+DOMAINS = ('light', 'switch', 'binary_sensor', 'sensor', 'input_boolean')
+
+
+def synthetic_states(count):
+    random.seed(count)
+    states = []
+    for i in range(count):
+        domain = DOMAINS[i % len(DOMAINS)]
+        attributes = {'friendly_name': f'{domain} {i}', 'supported_features': 0}
+        if domain == 'sensor':
+            state = f'{random.uniform(0, 3000):.1f}'
+            attributes.update({'unit_of_measurement': 'W', 'device_class': 'power'})
+        else:
+            state = random.choice(('on', 'off'))
+        if domain == 'light':
+            attributes.update({
+                'brightness': random.randint(0, 255),
+                'rgb_color': [255, 226, 145],
+                'min_mireds': 153,
+                'max_mireds': 500,
+                'supported_features': 63
+            })
+        states.append({
+            'entity_id': f'{domain}.entity_{i}',
+            'state': state,
+            'attributes': attributes,
+            'last_changed': '2020-08-01T10:00:00.123456+00:00',
+            'last_updated': '2020-08-01T10:00:00.123456+00:00',
+            'context': {'id': f'{i:032x}', 'parent_id': None, 'user_id': None}
+        })
+    return json.dumps(states)
+
+
+def retained(payload, build):
+    """Bytes still allocated by a store built from a decoded payload"""
+    gc.collect()
+    tracemalloc.start()
+    store = build(json.loads(payload))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entities', type=int, default=10000)
+    args = parser.parse_args()
+
+    payload = synthetic_states(args.entities)
+
+    def records(data):
+        state_manager = StateManager()
+        state_manager.load(data)
+        return state_manager
+
+    stores = {
+        'strings': lambda data: {d['entity_id']: d['state'] for d in data},
+        'raw': lambda data: {d['entity_id']: d for d in data},
+        'records': records,
+    }
+
+    print(f'entities: {args.entities}, tracked attributes: {", ".join(TRACKED_ATTRIBUTES)}')
+    built = {}
+    for name, build in stores.items():
+        size, built[name] = retained(payload, build)
+        print(f'{name:8} {size / 1024:10.1f} KiB  {size / args.entities:6.1f} B/entity')
+
+    entity_id = 'light.entity_0'
+    strings = built['strings']
+    state_manager = built['records']
+    reads = 1000000
+    old = timeit.timeit(lambda: bool(strings.get(entity_id).lower() == 'on'), number=reads)
+    new = timeit.timeit(lambda: state_manager.get_state(entity_id).value is True, number=reads)
+    print(f'bool read, string store: {old / reads * 1e9:6.1f} ns')
+    print(f'bool read, record store: {new / reads * 1e9:6.1f} ns')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""End to end benchmarks at several house sizes
+
+For each entity count the fake Home Assistant is started in a
+separate process with a synthetic mix of entities, and
+hass_ae.async_main is run against it to measure:
+
+    startup       - connect, auth, snapshot, subscribe and setup
+    memory        - bytes held by the state store per entity
+    event latency - time_fired of a state_changed event until a
+                    handler registered for it runs
+    call rtt      - round trip of sequential light.turn_on calls,
+                    alone and during a second burst of events
+
+With --command-connection service calls get their own connection,
+and round trips are also reported per connection.
+
+Results are printed, and written as json to --output so runs can
+be compared:
+
+    python -m benchmarks.bench_suite [--entities 10,1000,10000] [--command-connection]
+                                     [--output results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import hass_ae
+from hass_ae.client import parse_timestamp
+from benchmarks.fake_hass import send_command
+
+
+def deep_size(obj, seen=None):
+    """Size of obj and everything it references, counted once"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, name), seen)
+                    for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+
+def summary(samples):
+    """Milliseconds statistics of samples in seconds"""
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p95_ms': samples[int(len(samples) * 0.95)] * 1000,
+        'p99_ms': samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+async def measure(port, entities, events, rate, calls, command_connection):
+    context = {}
+    done = asyncio.Event()
+    latencies = []
+
+    async def on_event(data, client):
+        if data['event']['data']['entity_id'] == 'sensor.storm_done':
+            return
+        fired = parse_timestamp(data['event'].get('time_fired'))
+        latencies.append(time.time() - fired)
+
+    async def setup(client, state_manager, registry, timings):
+        context.update(client=client, state_manager=state_manager, timings=timings)
+
+        async def _done(value):
+            done.set()
+
+        await client.dispatcher.register_all('state_changed', on_event)
+        await state_manager.subscribe('sensor.storm_done', _done)
+
+    main = asyncio.create_task(hass_ae.async_main(
+        host='localhost',
+        port=port,
+        access_token='fake-token',
+        async_fn=setup,
+        queue_overflow='block',
+        command_connection=command_connection
+    ))
+    while 'timings' not in context or 'setup' not in context['timings'].phases:
+        await asyncio.sleep(0.01)
+
+    client = context['client']
+    state_manager = context['state_manager']
+    timings = context['timings']
+
+    store = deep_size(state_manager.states)
+
+    # the fake server answers on its own connection once all are sent
+    asyncio.create_task(send_command(port, {'type': 'fake/events', 'count': events, 'rate': rate}))
+    await done.wait()
+
+    light = next(e for e in state_manager.states if e.startswith('light.'))
+
+    async def call(i):
+        start = time.perf_counter()
+        await client.call_service(
+            domain='light',
+            service='turn_on',
+            data={'service_data': {'entity_id': light, 'brightness_pct': i % 100}})
+        return time.perf_counter() - start
+
+    round_trips = [await call(i) for i in range(calls)]
+
+    burst = asyncio.create_task(send_command(port, {'type': 'fake/events', 'count': events, 'rate': rate}))
+    loaded_round_trips = []
+    while not burst.done():
+        loaded_round_trips.append(await call(len(loaded_round_trips)))
+
+    main.cancel()
+    return {
+        'entities': entities,
+        'startup_ms': timings.total * 1000,
+        'startup_phases_ms': {k: v * 1000 for k, v in timings.phases.items()},
+        'state_bytes_per_entity': store / len(state_manager.states),
+        'events': len(latencies),
+        'event_rate': rate,
+        'event_latency': summary(latencies),
+        'call_rtt': summary(round_trips),
+        'call_rtt_under_load': summary(loaded_round_trips),
+        'connection_latency': {
+            connection: histogram.report()
+            for connection, histogram in client.connection_latency.items()},
+        'dropped': client.queue.dropped,
+        'max_backlog': client.max_backlog,
+    }
+
+
+def run(entities, events, rate, calls, command_connection=False):
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.fake_hass', '--port', '0',
+         '--entities', str(entities), '--synthetic'],
+        stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline().split()[-1])
+        return asyncio.run(measure(port, entities, events, rate, calls, command_connection))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(result):
+    print(f'{result["entities"]:>6} entities  '
+          f'startup {result["startup_ms"]:8.1f} ms  '
+          f'state {result["state_bytes_per_entity"]:6.0f} B/entity  '
+          f'event p50 {result["event_latency"]["p50_ms"]:6.2f} ms '
+          f'p99 {result["event_latency"]["p99_ms"]:6.2f} ms  '
+          f'call p50 {result["call_rtt"]["p50_ms"]:5.2f} ms '
+          f'p99 {result["call_rtt"]["p99_ms"]:5.2f} ms  '
+          f'under load p50 {result["call_rtt_under_load"].get("p50_ms", 0):5.2f} ms '
+          f'p99 {result["call_rtt_under_load"].get("p99_ms", 0):5.2f} ms')
+    for connection, latency in result['connection_latency'].items():
+        print(f'{"":>6} {connection:>8} connection  {latency}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entities', default='10,1000,10000')
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=1000, help='events per second')
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--command-connection', action='store_true',
+                        help='send service calls over a connection of their own')
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    results = []
+    for entities in (int(n) for n in args.entities.split(',')):
+        result = run(entities, args.events, args.rate, args.calls, args.command_connection)
+        report(result)
+        results.append(result)
+
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'command_connection': args.command_connection,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Cost of many concurrent Timers
+
+Arms N timers, restarts each of them R times, as motion sensors
+do on every trigger, and waits for all of them to fire. Compares
+the scheduler backed Timer with the original implementation of
+one task per timer waking every WEAKUP_INTERVAL:
+
+    tasks      - the original Timer
+    scheduler  - hass_ae.components.Timer
+
+Reports the time to arm and restart, the tasks alive while the
+timers are armed and how late callbacks run after their deadline.
+
+    python -m benchmarks.bench_timers [--timers N] [--restarts R]
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from hass_ae.components import Timer
+
+
+class TaskTimer():
+    """The original Timer, one sleeping task per timer"""
+
+    WEAKUP_INTERVAL = 60
+
+    def __init__(self, callback, timeout):
+        self.timeout = timeout
+        self.callback = callback
+        self.task = None
+
+    async def _timer_fn(self):
+        time_left = self.timeout
+        while time_left > self.WEAKUP_INTERVAL:
+            time_left -= self.WEAKUP_INTERVAL
+            await asyncio.sleep(self.WEAKUP_INTERVAL)
+        await asyncio.sleep(time_left)
+        await self.callback()
+
+    async def start(self):
+        self.task = asyncio.create_task(self._timer_fn())
+
+    async def restart(self):
+        await self.cancel()
+        await self.start()
+
+    async def cancel(self):
+        if self.task:
+            self.task.cancel()
+
+
+async def measure(class_, timers, restarts, timeout):
+    loop = asyncio.get_event_loop()
+    lateness = []
+    done = loop.create_future()
+
+    def make_callback(deadlines, i):
+        async def _callback():
+            lateness.append(loop.time() - deadlines[i])
+            if len(lateness) == timers and not done.done():
+                done.set_result(None)
+        return _callback
+
+    deadlines = [0] * timers
+    instances = [class_(make_callback(deadlines, i), timeout) for i in range(timers)]
+
+    start = time.perf_counter()
+    for i, timer in enumerate(instances):
+        deadlines[i] = loop.time() + timeout
+        await timer.start()
+    armed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(restarts):
+        for i, timer in enumerate(instances):
+            deadlines[i] = loop.time() + timeout
+            await timer.restart()
+    restarted = time.perf_counter() - start
+
+    # let cancelled tasks finish so only live timers are counted
+    await asyncio.sleep(0)
+    tasks = len(asyncio.all_tasks()) - 1
+
+    await done
+    return {
+        'arm_us': armed / timers * 1e6,
+        'restart_us': restarted / max(timers * restarts, 1) * 1e6,
+        'tasks': tasks,
+        'late_mean_ms': statistics.mean(lateness) * 1000,
+        'late_max_ms': max(lateness) * 1000,
+    }
+
+
+def report(name, result):
+    print(f'{name:10} arm {result["arm_us"]:6.2f} us  '
+          f'restart {result["restart_us"]:6.2f} us  '
+          f'tasks {result["tasks"]:6}  '
+          f'late mean {result["late_mean_ms"]:6.2f} ms  max {result["late_max_ms"]:6.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--timers', type=int, default=5000)
+    parser.add_argument('--restarts', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=1.0)
+    args = parser.parse_args()
+
+    print(f'{args.timers} timers, {args.restarts} restarts each, timeout {args.timeout}s')
+    for name, class_ in (('tasks', TaskTimer), ('scheduler', Timer)):
+        report(name, asyncio.run(measure(class_, args.timers, args.restarts, args.timeout)))
+
+
+if __name__ == '__main__':
+    main()
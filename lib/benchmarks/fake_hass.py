@@ -0,0 +1,448 @@
+"""Minimal local stand-in for the Home Assistant websocket api
+
+Only implements what hass_ae talks to: auth, get_states,
+subscribe_events, subscribe_entities, state triggers through
+subscribe_trigger, supported_features and call_service. Every
+service call that reaches the server is recorded with its
+arrival time so benchmarks can measure end to end latency. Like
+Home Assistant, it closes connections sending anything but auth
+before they are authenticated, and rejects message ids that don't
+increase.
+
+Connections that enable coalesce_messages get everything sent
+within one loop iteration packed into a single array frame.
+The fake/storm command fires a burst of state_changed events and
+fake/events fires them at a steady rate, which lets a benchmark
+run the server in another process:
+
+    python -m benchmarks.fake_hass --port 8124 --entities 100 [--synthetic]
+
+With --synthetic the server holds a mix of lights, switches,
+sensors and binary sensors instead of plain storm sensors.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import time
+import logging
+import websockets
+
+logger = logging.getLogger(__name__)
+
+
+class FakeHomeAssistant:
+
+    def __init__(self, states=None, access_token='fake-token'):
+        self.states = states or []
+        self.access_token = access_token
+        self.server = None
+        self.connections = []
+        self.subscriptions = {}
+        self.entity_subscriptions = []
+        self.trigger_subscriptions = []
+        self.service_calls = []
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self._coalesce = {}
+        self._last_ids = {}
+        self._service_call_event = asyncio.Event()
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self, host='localhost', port=0):
+        self.server = await websockets.serve(self._handler, host, port)
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def fire_event(self, event_type, data, time_fired='2020-08-01T10:00:00.000000+00:00'):
+        """Send an event to every connection subscribed to event_type,
+        and state_changed to the state triggers of the entity
+        """
+        for socket, identity in self.subscriptions.get(event_type, []):
+            await self._send(socket, {
+                'id': identity,
+                'type': 'event',
+                'event': {
+                    'event_type': event_type,
+                    'data': data,
+                    'origin': 'LOCAL',
+                    'time_fired': time_fired,
+                    'context': {'id': 'fake', 'parent_id': None, 'user_id': None}
+                }
+            })
+
+        if event_type != 'state_changed':
+            return
+        for socket, identity, entity_ids in self.trigger_subscriptions:
+            if data['entity_id'] in entity_ids:
+                await self._send(socket, {
+                    'id': identity,
+                    'type': 'event',
+                    'event': {
+                        'variables': {'trigger': {
+                            'id': '0',
+                            'idx': '0',
+                            'platform': 'state',
+                            'entity_id': data['entity_id'],
+                            'from_state': data['old_state'],
+                            'to_state': data['new_state'],
+                            'for': None,
+                            'attribute': None,
+                            'description': f'state of {data["entity_id"]}'
+                        }},
+                        'context': {'id': 'fake', 'parent_id': None, 'user_id': None}
+                    }
+                })
+
+    async def set_state(self, entity_id, state, attributes=None):
+        """Change an entity and notify state_changed and entity subscribers"""
+        old_state = next((s for s in self.states if s['entity_id'] == entity_id), None)
+        new_state = make_state(entity_id, state, attributes, changed=now())
+        if old_state is not None and old_state['state'] == state:
+            new_state['last_changed'] = old_state['last_changed']
+        if old_state is None:
+            self.states.append(new_state)
+        else:
+            self.states[self.states.index(old_state)] = new_state
+
+        await self.fire_event('state_changed', {
+            'entity_id': entity_id,
+            'old_state': old_state,
+            'new_state': new_state
+        })
+
+        diff = {'+': compressed_state(new_state)}
+        for socket, identity, entity_ids in self.entity_subscriptions:
+            if entity_ids is None or entity_id in entity_ids:
+                await self._send(socket, {
+                    'id': identity,
+                    'type': 'event',
+                    'event': {'c': {entity_id: diff}}
+                })
+
+    async def drop_connections(self):
+        """Close every client connection, as a Home Assistant restart would"""
+        for socket in list(self.connections):
+            await socket.close()
+
+    async def storm(self, count, entities=100):
+        """Fire count state_changed events spread over entities
+
+        Ends with a change of sensor.storm_done to 'done'.
+        """
+        for i in range(count):
+            entity_id = f'sensor.storm_{i % entities}'
+            await self.fire_event('state_changed', {
+                'entity_id': entity_id,
+                'old_state': make_state(entity_id, str(i - entities)),
+                'new_state': make_state(entity_id, str(i))
+            })
+            if i % 50 == 0:
+                await asyncio.sleep(0)
+
+        await self.fire_event('state_changed', {
+            'entity_id': 'sensor.storm_done',
+            'old_state': None,
+            'new_state': make_state('sensor.storm_done', 'done')
+        })
+
+    async def events(self, count, rate):
+        """Fire count state_changed events at rate per second
+
+        Events cycle through the known states and carry their real
+        time_fired. Ends with a change of sensor.storm_done to 'done'.
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        for i in range(count):
+            old_state = self.states[i % len(self.states)]
+            if old_state['entity_id'].startswith('sensor.'):
+                value = str(i)
+            else:
+                value = 'off' if old_state['state'] == 'on' else 'on'
+            new_state = dict(old_state, state=value, last_updated=now())
+            self.states[i % len(self.states)] = new_state
+            await self.fire_event('state_changed', {
+                'entity_id': new_state['entity_id'],
+                'old_state': old_state,
+                'new_state': new_state
+            }, time_fired=now())
+
+            delay = start + (i + 1) / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        await self.fire_event('state_changed', {
+            'entity_id': 'sensor.storm_done',
+            'old_state': None,
+            'new_state': make_state('sensor.storm_done', 'done')
+        })
+
+    async def press(self, switch, event=1002):
+        await self.fire_event('deconz_event', {'id': switch, 'event': event})
+
+    async def wait_for_service_call(self, domain, service, entity_id):
+        """Wait until a matching call_service has been received
+
+        Returns the perf_counter timestamp of its arrival
+        """
+        while True:
+            for call in self.service_calls:
+                if call['matched']:
+                    continue
+                request = call['request']
+                service_data = request.get('service_data', {})
+                if (request['domain'], request['service']) != (domain, service):
+                    continue
+                if service_data.get('entity_id') != entity_id:
+                    continue
+                call['matched'] = True
+                return call['received']
+            self._service_call_event.clear()
+            await self._service_call_event.wait()
+
+    async def _handler(self, socket, path=None):
+        self.connections.append(socket)
+        await self._send(socket, {'type': 'auth_required'})
+        try:
+            async for message in socket:
+                await self._handle(socket, json.loads(message))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.connections.remove(socket)
+            self._coalesce.pop(socket, None)
+            self._last_ids.pop(socket, None)
+            for subscribers in self.subscriptions.values():
+                subscribers[:] = [s for s in subscribers if s[0] is not socket]
+            self.entity_subscriptions[:] = [
+                s for s in self.entity_subscriptions if s[0] is not socket]
+            self.trigger_subscriptions[:] = [
+                s for s in self.trigger_subscriptions if s[0] is not socket]
+
+    async def _handle(self, socket, data):
+        type_ = data['type']
+
+        if type_ == 'auth':
+            if data['access_token'] == self.access_token:
+                self._last_ids[socket] = 0
+                await self._send(socket, {'type': 'auth_ok'})
+            else:
+                await self._send(socket, {'type': 'auth_invalid'})
+            return
+
+        if socket not in self._last_ids:
+            # anything but auth during the auth phase ends the connection
+            await self._send(socket, {'type': 'auth_invalid', 'message': 'Auth message incorrectly formatted'})
+            return await socket.close()
+
+        if data['id'] <= self._last_ids[socket]:
+            return await self._send(socket, {
+                'id': data['id'],
+                'type': 'result',
+                'success': False,
+                'error': {'code': 'id_reuse', 'message': 'Identifier values have to increase.'}
+            })
+        self._last_ids[socket] = data['id']
+
+        if type_ == 'supported_features':
+            if data.get('features', {}).get('coalesce_messages'):
+                self._coalesce[socket] = []
+            return await self._result(socket, data['id'])
+
+        if type_ == 'fake/storm':
+            await self.storm(data['count'], data.get('entities', 100))
+            return await self._result(socket, data['id'])
+
+        if type_ == 'fake/events':
+            await self.events(data['count'], data['rate'])
+            return await self._result(socket, data['id'])
+
+        if type_ == 'get_states':
+            return await self._result(socket, data['id'], self.states)
+
+        if type_ == 'subscribe_events':
+            self.subscriptions.setdefault(data['event_type'], []).append(
+                (socket, data['id']))
+            return await self._result(socket, data['id'])
+
+        if type_ == 'subscribe_entities':
+            entity_ids = data.get('entity_ids')
+            self.entity_subscriptions.append((socket, data['id'], entity_ids))
+            await self._result(socket, data['id'])
+            return await self._send(socket, {
+                'id': data['id'],
+                'type': 'event',
+                'event': {'a': {
+                    s['entity_id']: compressed_state(s) for s in self.states
+                    if entity_ids is None or s['entity_id'] in entity_ids
+                }}
+            })
+
+        if type_ == 'subscribe_trigger' and data['trigger'].get('platform') == 'state':
+            entity_ids = data['trigger']['entity_id']
+            if isinstance(entity_ids, str):
+                entity_ids = [entity_ids]
+            self.trigger_subscriptions.append((socket, data['id'], set(entity_ids)))
+            return await self._result(socket, data['id'])
+
+        if type_ == 'call_service':
+            self.service_calls.append({
+                'received': time.perf_counter(),
+                'request': data,
+                'matched': False
+            })
+            self._service_call_event.set()
+            return await self._result(socket, data['id'], {'context': {'id': 'fake'}})
+
+        await self._send(socket, {
+            'id': data.get('id'),
+            'type': 'result',
+            'success': False,
+            'error': {'code': 'unknown_command', 'message': 'Unknown command.'}
+        })
+
+    async def _result(self, socket, identity, result=None):
+        await self._send(socket, {
+            'id': identity,
+            'type': 'result',
+            'success': True,
+            'result': result
+        })
+
+    async def _send(self, socket, data):
+        buffer = self._coalesce.get(socket)
+        if buffer is None:
+            return await self._send_frame(socket, data)
+
+        buffer.append(data)
+        if len(buffer) == 1:
+            asyncio.get_event_loop().create_task(self._flush(socket))
+
+    async def _flush(self, socket):
+        await asyncio.sleep(0)
+        buffer = self._coalesce.get(socket)
+        if buffer:
+            self._coalesce[socket] = []
+            await self._send_frame(socket, buffer)
+
+    async def _send_frame(self, socket, data):
+        message = json.dumps(data)
+        self.bytes_sent += len(message)
+        self.frames_sent += 1
+        try:
+            await socket.send(message)
+        except websockets.ConnectionClosed:
+            pass
+
+
+def make_state(entity_id, state='off', attributes=None,
+               changed='2020-08-01T10:00:00.000000+00:00'):
+    return {
+        'entity_id': entity_id,
+        'state': state,
+        'attributes': attributes or {},
+        'last_changed': changed,
+        'last_updated': changed,
+        'context': {'id': 'fake', 'parent_id': None, 'user_id': None}
+    }
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def synthetic_states(count):
+    """count states of a mix of domains with typical attributes"""
+    states = []
+    for i in range(count):
+        kind = i % 5
+        if kind == 0:
+            states.append(make_state(f'light.synthetic_{i}', 'on', {
+                'brightness': i % 256,
+                'rgb_color': [255, 226, 145],
+                'min_mireds': 153,
+                'max_mireds': 500,
+                'supported_features': 63,
+                'friendly_name': f'Light {i}'
+            }))
+        elif kind == 1:
+            states.append(make_state(f'switch.synthetic_{i}', 'off', {
+                'friendly_name': f'Switch {i}'
+            }))
+        elif kind == 2:
+            states.append(make_state(f'binary_sensor.synthetic_{i}', 'off', {
+                'device_class': 'motion',
+                'friendly_name': f'Motion {i}'
+            }))
+        elif kind == 3:
+            states.append(make_state(f'sensor.synthetic_{i}', str(i * 1.5), {
+                'unit_of_measurement': 'W',
+                'device_class': 'power',
+                'friendly_name': f'Power {i}'
+            }))
+        else:
+            states.append(make_state(f'input_boolean.synthetic_{i}', 'on', {
+                'editable': True,
+                'friendly_name': f'Boolean {i}'
+            }))
+    return states
+
+
+async def send_command(port, request, access_token='fake-token'):
+    """Send a request on a separate connection and wait for its result"""
+    async with websockets.connect(f'ws://localhost:{port}/api/websocket') as socket:
+        await socket.recv()
+        await socket.send(json.dumps({'type': 'auth', 'access_token': access_token}))
+        await socket.recv()
+        await socket.send(json.dumps(dict(request, id=1)))
+        return json.loads(await socket.recv())
+
+
+def compressed_state(state):
+    """State in the compressed form used by subscribe_entities,
+    with lu only when it differs from lc, as Home Assistant does
+    """
+    compressed = {
+        's': state['state'],
+        'a': state['attributes'],
+        'c': state['context']['id'],
+        'lc': timestamp(state['last_changed'])
+    }
+    if state['last_updated'] != state['last_changed']:
+        compressed['lu'] = timestamp(state['last_updated'])
+    return compressed
+
+
+def timestamp(value):
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+async def serve(port, entities, synthetic=False):
+    if synthetic:
+        states = synthetic_states(entities)
+    else:
+        states = [make_state(f'sensor.storm_{i}', '0') for i in range(entities)]
+    server = await FakeHomeAssistant(states=states).start(port=port)
+    print(f'fake home assistant listening on port {server.port}', flush=True)
+    await asyncio.Future()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8124)
+    parser.add_argument('--entities', type=int, default=100)
+    parser.add_argument('--synthetic', action='store_true')
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.entities, args.synthetic))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Replay a websocket capture through an automation setup
+
+Captures are recorded by running with RECORD set to a path, see
+hass_ae.recording. Prints a json report of event throughput,
+handler latency and the service calls made:
+
+    python -m benchmarks.replay capture.log --setup automation:setup [--speed N]
+
+Without --speed the events are replayed as fast as possible.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+
+from hass_ae.recording import Replay
+
+
+def load_setup(name):
+    """Import a setup function given as module:function"""
+    module, _, function = name.partition(':')
+    return getattr(importlib.import_module(module), function or 'setup')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture')
+    parser.add_argument('--setup', default='automation:setup')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='speed up factor, as fast as possible if left out')
+    args = parser.parse_args()
+
+    replay = Replay(args.capture, load_setup(args.setup), args.speed)
+    print(json.dumps(asyncio.run(replay.run()), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,11 @@ import logging
 import asyncio
 import hass_ae
 import hass_ae.client
+import hass_ae.codec
 import hass_ae.config
 import hass_ae.components
+import hass_ae.metrics
+import hass_ae.recording
 
 
 def run(config, async_fn):
@@ -12,35 +15,116 @@ def run(config, async_fn):
         host=config['host'],
         port=config['port'],
         access_token=config['access_token'],
-        async_fn=async_fn
+        async_fn=async_fn,
+        queue_size=int(config['queue_size']),
+        queue_overflow=config['queue_overflow'],
+        queue_workers=int(config['queue_workers']),
+        state_sync=config['state_sync'],
+        coalesce_messages=str(config['coalesce_messages']).lower() in ('1', 'true', 'yes'),
+        call_timeout=float(config['call_timeout']),
+        batch_calls=str(config['batch_calls']).lower() in ('1', 'true', 'yes'),
+        call_limits={
+            key.strip(): int(limit)
+            for key, limit in (item.split('=') for item in config['call_limits'].split(',') if item)},
+        command_intervals={
+            key.strip(): float(interval)
+            for key, interval in (
+                item.split('=') for item in config['command_intervals'].split(',') if item)},
+        record=config['record'] or None,
+        json_codec=config['json_codec'],
+        lazy_decode=str(config['lazy_decode']).lower() in ('1', 'true', 'yes'),
+        state_triggers=(
+            'auto' if str(config['state_triggers']).lower() == 'auto'
+            else str(config['state_triggers']).lower() in ('1', 'true', 'yes')),
+        command_connection=str(config['command_connection']).lower() in ('1', 'true', 'yes')
         ))
     loop.close()
 
 
-async def async_main(host, port, access_token, async_fn):
-    ws = hass_ae.client.Websocket()
-    state_manager = hass_ae.client.StateManager()
-    registry = hass_ae.components.ComponentRegistry()
-    client = hass_ae.client.Client(ws)
+async def async_main(host, port, access_token, async_fn,
+                     queue_size=1000, queue_overflow='drop_oldest', queue_workers=8,
+                     state_sync='state_changed', coalesce_messages=True, call_timeout=30,
+                     batch_calls=False, call_limits=None, record=None,
+                     json_codec='auto', lazy_decode=False, state_triggers='auto',
+                     command_connection=False, command_intervals=None):
+    sync_mode = hass_ae.client.SyncMode(state_sync)
+    if state_triggers == 'auto':
+        # state triggers duplicate the state_changed stream, which
+        # only subscribe_entities sync does without
+        state_triggers = sync_mode == hass_ae.client.SyncMode.SUBSCRIBE_ENTITIES
 
-    await client.connect(host, port)
+    recorder = hass_ae.recording.FrameRecorder(record) if record else None
+    try:
+        codec = hass_ae.codec.get_codec(json_codec)
+        ws = hass_ae.client.Websocket(recorder=recorder, codec=codec, lazy=lazy_decode)
+        command_ws = None
+        if command_connection:
+            command_ws = hass_ae.client.Websocket(recorder=recorder, codec=codec)
+        state_manager = hass_ae.client.StateManager()
+        timings = hass_ae.metrics.PhaseTimer()
+        registry = hass_ae.components.ComponentRegistry(timings=timings)
+        queue = hass_ae.client.EventQueue(maxsize=queue_size, policy=queue_overflow)
+        client = hass_ae.client.Client(
+            ws, queue=queue, workers=queue_workers, reconnect=True, call_timeout=call_timeout,
+            batch_calls=batch_calls, call_limits=call_limits, state_triggers=state_triggers,
+            command_websocket=command_ws, command_intervals=command_intervals)
 
-    listen_task = asyncio.create_task(client.listen())
+        with timings.phase('connect'):
+            await client.connect(host, port)
+        client.on_disconnect(lambda client: state_manager.mark_unsynced())
+        queue.on_drop(state_manager.frame_dropped)
 
-    await client.authenticate(access_token)
+        listen_task = asyncio.create_task(client.listen())
 
-    states = await client.get_states()
-    state_manager.load(states)
-    
-    await client.subscribe(
-        'state_changed', 
-        lambda data, client: state_manager.event_callback(data)
-        )
+        with timings.phase('auth'):
+            await client.authenticate(access_token)
 
-    await async_fn(
-        client=client,
-        state_manager=state_manager,
-        registry=registry
-        )
+            if coalesce_messages:
+                await client.supported_features(coalesce_messages=True)
+                if lazy_decode:
+                    logging.getLogger(__name__).warning(
+                        'lazy_decode has little effect with coalesce_messages enabled, '
+                        'coalesced frames are decoded in full')
 
-    await listen_task
\ No newline at end of file
+        if sync_mode == hass_ae.client.SyncMode.SUBSCRIBE_ENTITIES:
+            # states are synced once the components are registered
+            async def _sync(registry):
+                with timings.phase('snapshot'):
+                    await state_manager.sync_entities(client, registry.entity_ids)
+            registry.before_subscribe(_sync)
+        else:
+            with timings.phase('snapshot'):
+                states = await client.get_states()
+                state_manager.load(states)
+
+            async def _state_changed(data, client):
+                await state_manager.event_callback(data)
+
+            if lazy_decode:
+                # only events of registered entities are decoded, other
+                # entities keep their snapshot state
+                async def _follow(registry):
+                    for entity_id in registry.entity_ids:
+                        await client.dispatcher.register('state_changed', entity_id, _state_changed)
+                registry.before_subscribe(_follow)
+            else:
+                await client.dispatcher.register_all('state_changed', _state_changed)
+
+            async def _resync(client):
+                await state_manager.resync(await client.get_states())
+            client.on_reconnect(_resync)
+
+        # setup includes subscribe, and snapshot when syncing entities
+        with timings.phase('setup'):
+            await async_fn(
+                client=client,
+                state_manager=state_manager,
+                registry=registry,
+                timings=timings
+                )
+        logging.getLogger(__name__).info(f'Startup: {timings.report()}')
+
+        await listen_task
+    finally:
+        if recorder:
+            recorder.close()
@@ -4,29 +4,84 @@ import asyncio
 import json
 import websockets
 import logging
-import cachetools
 import enum
-from collections import defaultdict
+import sys
+import datetime
+from collections import defaultdict, deque
+import hass_ae.clock
+import hass_ae.codec
+import hass_ae.metrics
 
 logger = logging.getLogger(__name__)
 
 class ReservedIdentities(enum.Enum):
     AUTH = -1
+    COMMAND_AUTH = -2
+
+class OverflowPolicy(enum.Enum):
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+
+class SyncMode(enum.Enum):
+    # get_states snapshot followed by every state_changed event
+    STATE_CHANGED = 'state_changed'
+    # subscribe_entities, limited to registered components
+    SUBSCRIBE_ENTITIES = 'subscribe_entities'
+
+# Error code of calls that got no result in time
+TIMEOUT = 'timeout'
+
+# Error code of batched calls whose request could not be sent
+SEND_FAILED = 'send_failed'
+
+# Error code of calls whose waiting task was cancelled
+CANCELLED = 'cancelled'
+
+# Connections of a Client, see Call.connection
+MAIN_CONNECTION = 'main'
+COMMAND_CONNECTION = 'command'
+
+# Frame types handled directly by the listener, ahead of queued events
+PRIORITY_TYPES = ('result', 'auth_ok', 'auth_invalid', 'auth_required')
+
+# Keys of subscribe_entities messages: added, changed and removed entities
+ENTITY_DIFF_KEYS = {'a', 'c', 'r'}
+
+# Attributes kept by StateManager, everything else is discarded
+TRACKED_ATTRIBUTES = ('brightness', 'rgb_color', 'color_temp')
+
+# Functions extracting the key an event is routed on, per event type
+ROUTING_KEYS = {
+    event_type: lambda data, field=field: data['event']['data'][field]
+    for event_type, field in hass_ae.codec.ROUTING_FIELDS.items()
+}
 
 class Websocket:
     """Class for managing a websocket connection
 
     This implementation must not contain any api-specific
-    logic.
+    logic. Frames are passed to the recorder, if any, see
+    hass_ae.recording.FrameRecorder. With lazy set, event frames
+    are returned undecoded as hass_ae.codec.LazyMessage.
     """
 
-    def __init__(self):
+    # get_states of a large house is well over the 1 MiB default
+    MAX_MESSAGE_SIZE = None
+
+    def __init__(self, recorder=None, codec=None, lazy=False):
         self.socket = None
+        self.recorder = recorder
+        self.codec = codec or hass_ae.codec.get_codec()
+        self.lazy = lazy
+        self.frames_received = 0
+        self.messages_received = 0
+        self._pending = deque()
 
     async def connect(self, host, port):
         url = f'ws://{host}:{port}/api/websocket'
         logger.info(f'Connecting on {url}')
-        self.socket = await websockets.connect(url)
+        self.socket = await websockets.connect(url, max_size=self.MAX_MESSAGE_SIZE)
+        self._pending.clear()
 
     async def close(self):
         await self.socket.close()
@@ -35,16 +90,45 @@ class Websocket:
         logger.debug(f'sending: {data}')
         if not data:
             raise ValueError('data is empty')
-        await self._send_raw(json.dumps(data))
+        if self.recorder:
+            self.recorder.sent(data)
+        await self._send_raw(self.codec.dumps(data))
 
     async def receive(self):
-        try:
-            message = await self.socket.recv()
-            message = json.loads(message)
-            return message
-        except:
-            logger.exception('Failed to recieve event')
-            raise
+        """Receive the next message
+
+        A frame holding a json array carries several messages,
+        they are returned one at a time. Returns None once the
+        connection is closed.
+        """
+        while not self._pending:
+            try:
+                message = await self.socket.recv()
+                if self.recorder:
+                    self.recorder.received(message)
+                if self.lazy and isinstance(message, str):
+                    lazy = hass_ae.codec.LazyMessage.parse(message, self.codec)
+                    if lazy is not None:
+                        self.frames_received += 1
+                        self.messages_received += 1
+                        return lazy
+                message = self.codec.loads(message)
+            except websockets.ConnectionClosed as e:
+                logger.warning(f'Connection closed: {e}')
+                return None
+            except:
+                logger.exception('Failed to recieve event')
+                raise
+
+            self.frames_received += 1
+            if not isinstance(message, list):
+                self.messages_received += 1
+                return message
+
+            self.messages_received += len(message)
+            self._pending.extend(message)
+
+        return self._pending.popleft()
 
     async def _send_raw(self, message):
         try:
@@ -57,108 +141,524 @@ class Client:
     """Class containing high level service functions for
     integration with Home Assistant websocket
 
-    Uses a websocket instance
+    Uses a websocket instance. With reconnect enabled a lost
+    connection is re-established with exponential backoff, and
+    authentication, features and subscriptions are restored.
+
+    Calls raise CallTimeoutError when no result arrives within
+    call_timeout seconds, which each call can override. A timeout
+    of 0 waits without limit. Round trip times are collected in
+    latency, per service for call_service and per type otherwise.
+
+    With batch_calls enabled, service calls on single entities
+    issued in the same loop iteration are merged, see CallBatcher.
+    call_limits caps concurrent service calls per network tag or
+    domain, see CallLimiter. command_intervals holds the default
+    minimum seconds between commands to one entity per domain, see
+    hass_ae.components.CommandChannel.
+
+    With state_triggers enabled, components following single
+    entities get their state changes through a state trigger
+    instead of the state_changed stream, see EventDispatcher.
+    This only saves traffic when nothing else subscribes to
+    state_changed.
+
+    Given a command_websocket, service calls go over a second
+    connection of their own, authenticated separately, so their
+    results never wait behind event frames or a large get_states.
+    If that connection is down the calls use the main connection.
+    Round trip times are also collected per connection in
+    connection_latency.
     """
-    def __init__(self, websocket):
+
+    RECONNECT_BACKOFF_MIN = 1
+    RECONNECT_BACKOFF_MAX = 60
+
+    def __init__(self, websocket, queue=None, workers=8, reconnect=False, call_timeout=30,
+                 batch_calls=False, call_limits=None, state_triggers=False,
+                 command_websocket=None, command_intervals=None):
         self.ws = websocket
+        self.command_ws = command_websocket
         self.identity = identity()
         self.subscriptions = {}
-        self.calls = cachetools.TTLCache(maxsize=101, ttl=360)
+        self.subscription_requests = {}
+        self.calls = PendingCalls(timeout=call_timeout)
+        self.latency = defaultdict(hass_ae.metrics.Histogram)
+        self.connection_latency = defaultdict(hass_ae.metrics.Histogram)
+        self.dispatcher = EventDispatcher(self, triggers=state_triggers)
+        self.batcher = CallBatcher(self) if batch_calls else None
+        self.limiter = CallLimiter(call_limits)
+        self.command_intervals = command_intervals or {}
+        self.queue = queue or EventQueue()
+        self.workers = workers
+        self.reconnect = reconnect
+        self.reconnect_callbacks = []
+        self.disconnect_callbacks = []
+        self._worker_tasks = []
+        self._backlog = deque()
+        self._feeder = None
+        self.max_backlog = 0
+        self._command_task = None
+        self._command_ready = False
+        self._authenticated = None
+        self._address = None
+        self._access_token = None
+        self._features = {}
+        self._backoff = self.RECONNECT_BACKOFF_MIN
 
     async def connect(self, host='localhost', port='8124'):
+        self._address = (host, port)
+        # set while the main connection is authenticated
+        self._authenticated = asyncio.Event()
         await self.ws.connect(host, port)
+        if self.command_ws is not None:
+            await self.command_ws.connect(host, port)
 
-    async def listen(self, blocking=True):
+    def on_reconnect(self, callback):
+        """Register a coroutine function called with the client
+        once a reconnected session has been restored
+        """
+        self.reconnect_callbacks.append(callback)
 
-        async def _handle(data):
-            try:
-                await self.handle_event(data)
-            except:
-                logger.exception('Failure while handling event')
-   
-        logger.info('listner started')
-        while True:
-            data = await self.ws.receive()
-            if not data:
-                raise RuntimeError('no data, exiting')
+    def on_disconnect(self, callback):
+        """Register a function called with the client as soon as
+        the main connection is lost
+        """
+        self.disconnect_callbacks.append(callback)
 
-            asyncio.create_task(_handle(data))
+    async def listen(self, blocking=True):
+        """Read frames from the websocket
+
+        Results and auth frames are handled as soon as they are
+        read. Events are put on the bounded event queue and
+        handled by a fixed pool of workers, in order per entity
+        and in parallel across entities.
+        """
+        if not self._worker_tasks:
+            self._worker_tasks = [
+                asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.command_ws is not None and self._command_task is None:
+            self._command_task = asyncio.create_task(self._listen_commands())
 
-            if not blocking:
-                break
+        logger.info('listner started')
+        try:
+            while True:
+                data = await self.ws.receive()
+                if data is None:
+                    if not self.reconnect:
+                        raise RuntimeError('no data, exiting')
+                    await self._reconnect()
+                    continue
+
+                if data.get('type') in PRIORITY_TYPES:
+                    await self._handle(data)
+                else:
+                    self._enqueue(data)
+
+                if not blocking:
+                    break
+        except:
+            self._stop_workers()
+            raise
 
         logger.info('listner terminated')
 
+    @property
+    def depth(self):
+        """Events waiting to be handled, queued or in the backlog"""
+        return self.queue.depth + len(self._backlog)
+
+    def _enqueue(self, data):
+        """Queue an event without holding up the listener
+
+        When a blocking queue is full, events wait in arrival order
+        in the backlog and a single task feeds them to the queue as
+        room frees up. The listener keeps reading meanwhile, so the
+        results the workers wait for are never stuck behind events.
+
+        The backlog holds at most as many events as the queue. Past
+        that, the oldest backlogged event for the same key, or the
+        oldest overall, is dropped and counted in queue.dropped.
+        Entity diffs are never dropped, as in the queue.
+        """
+        key = queue_key(data)
+        lossless = is_entity_diff(data)
+        if self.queue.policy != OverflowPolicy.BLOCK or not (self._backlog or self.queue.full()):
+            return self.queue.put_nowait(key, data, lossless)
+
+        if not lossless and len(self._backlog) >= self.queue.maxsize:
+            self._drop_backlog(key)
+        self._backlog.append((key, data, lossless))
+        self.max_backlog = max(self.max_backlog, len(self._backlog))
+        if self._feeder is None:
+            self._feeder = asyncio.create_task(self._feed())
+
+    def _drop_backlog(self, key):
+        index = next((i for i, (k, _, lossless) in enumerate(self._backlog)
+                      if k == key and not lossless), None)
+        if index is None:
+            index = next((i for i, (_, _, lossless) in enumerate(self._backlog)
+                          if not lossless), None)
+            if index is None:
+                # only entity diffs are backlogged
+                return
+        dropped_key = self._backlog[index][0]
+        del self._backlog[index]
+        self.queue.count_drop(dropped_key)
+        logger.debug(f'Event backlog full, dropped oldest event for {dropped_key}')
 
-    async def authenticate(self, access_token):
+    async def _feed(self):
+        try:
+            while self._backlog:
+                # taken off the backlog first, so drops never hit it
+                key, data, lossless = self._backlog.popleft()
+                await self.queue.put(key, data, lossless)
+        finally:
+            self._feeder = None
+
+    async def _listen_commands(self):
+        """Read results from the command connection
+
+        Nothing but results and auth frames arrive on it, so they
+        are all handled as soon as they are read.
+        """
+        while True:
+            data = await self.command_ws.receive()
+            if data is None:
+                self._command_ready = False
+                self._fail_pending('connection_lost', COMMAND_CONNECTION)
+                if not self.reconnect:
+                    logger.warning('Command connection closed, calls go over the main connection')
+                    self._command_task = None
+                    return
+                await self._connect(self.command_ws)
+                asyncio.create_task(self._restore_commands())
+                continue
+
+            if data['type'] in ('auth_ok', 'auth_invalid'):
+                self.auth_handler(data, ReservedIdentities.COMMAND_AUTH.value)
+            else:
+                await self._handle(data)
+
+    async def _reconnect(self):
+        # requests wait until the new connection is authenticated,
+        # Home Assistant closes connections sending them before
+        self._authenticated.clear()
+        for callback in self.disconnect_callbacks:
+            callback(self)
+        self._fail_pending('connection_lost', MAIN_CONNECTION)
+        await self._connect(self.ws)
+
+        # the listener must keep reading while the session is restored
+        asyncio.create_task(self._restore())
+
+    async def _connect(self, websocket):
+        """Connect websocket, retrying with backoff until it succeeds"""
+        while True:
+            try:
+                await websocket.connect(*self._address)
+                break
+            except (OSError, websockets.WebSocketException) as e:
+                logger.warning(f'Reconnect failed ({e}), retrying in {self._backoff}s')
+                await hass_ae.clock.sleep(self._backoff)
+                self._backoff = min(self._backoff * 2, self.RECONNECT_BACKOFF_MAX)
+
+    async def _restore_commands(self):
+        try:
+            await self._authenticate(self.command_ws, ReservedIdentities.COMMAND_AUTH)
+        except Exception:
+            logger.exception(f'Failed to restore command connection, reconnecting in {self._backoff}s')
+            await hass_ae.clock.sleep(self._backoff)
+            self._backoff = min(self._backoff * 2, self.RECONNECT_BACKOFF_MAX)
+            await self.command_ws.close()
+            return
+
+        self._command_ready = True
+        logger.info('Command connection restored')
+
+    async def _restore(self):
+        try:
+            await self._authenticate(self.ws, ReservedIdentities.AUTH)
+            if self._features:
+                await self.supported_features(**self._features)
+            await self._replay_subscriptions()
+            for callback in self.reconnect_callbacks:
+                await callback(self)
+        except Exception:
+            logger.exception(f'Failed to restore session, reconnecting in {self._backoff}s')
+            await hass_ae.clock.sleep(self._backoff)
+            self._backoff = min(self._backoff * 2, self.RECONNECT_BACKOFF_MAX)
+            await self.ws.close()
+            return
+
+        self._backoff = self.RECONNECT_BACKOFF_MIN
+        logger.info('Session restored')
+
+    async def _replay_subscriptions(self):
+        """Resubscribe everything, sending all requests before
+        awaiting any result
+        """
+        calls = []
+        for old_identity, request in list(self.subscription_requests.items()):
+            identity = next(self.identity)
+            self.subscriptions[identity] = self.subscriptions.pop(old_identity)
+            self.subscription_requests[identity] = self.subscription_requests.pop(old_identity)
+            call = Call(
+                identity=identity,
+                request=dict(request, id=identity),
+                description=f'Replaying subscription {old_identity} as {identity}'
+                )
+            await self.execute_call(call)
+            calls.append(call)
+
+        await asyncio.gather(*(call.wait_for_complete() for call in calls))
+        logger.info(f'Replayed {len(calls)} subscriptions')
+
+    def _fail_pending(self, code, connection):
+        for call in self.calls.clear(lambda call: call.connection == connection):
+            call.fail(error_result(
+                call.identity, code, 'Connection lost before a result arrived'))
+
+    async def _worker(self):
+        while True:
+            key, data = await self.queue.get()
+            while data is not None:
+                await self._handle(data)
+                data = self.queue.next(key)
+
+    def _stop_workers(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        self._worker_tasks = []
+        if self._feeder is not None:
+            self._feeder.cancel()
+        if self._command_task is not None:
+            self._command_task.cancel()
+            self._command_task = None
+
+    async def _handle(self, data):
+        try:
+            await self.handle_event(data)
+        except Exception:
+            logger.exception('Failure while handling event')
+
+
+    async def authenticate(self, access_token, timeout=None):
+        """Authenticate the main connection, then the command
+        connection if there is one
+        """
+        self._access_token = access_token
+        data = await self._authenticate(self.ws, ReservedIdentities.AUTH, timeout)
+        if self.command_ws is not None:
+            await self._authenticate(self.command_ws, ReservedIdentities.COMMAND_AUTH, timeout)
+            self._command_ready = True
+        return data
+
+    async def _authenticate(self, websocket, identity, timeout=None):
         call = Call(
-            identity=ReservedIdentities.AUTH.value,
-            request={'type': 'auth', 'access_token': access_token},
+            identity=identity.value,
+            request={'type': 'auth', 'access_token': self._access_token},
             description=f'Authenticating'
             )
-        await self.execute_call(call)
-        await call.wait_for_complete()
+        await self.execute_call(call, timeout, websocket)
+        await self.wait_for_call(call)
+        if not call.is_ok:
+            raise AuthenticationError(f'Authentication failed: {call.response}')
+        if websocket is self.ws:
+            self._authenticated.set()
         return call.data
 
-    async def subscribe(self, event_type, handler):
+    async def supported_features(self, timeout=None, **features):
+        """Enable optional websocket api features, e.g. coalesce_messages"""
+        self._features = features
+        call = Call(
+            identity=None,
+            request={
+                'type': 'supported_features',
+                'features': {k: int(v) for k, v in features.items()}
+                },
+            description=f'Enabling features: {", ".join(features)}'
+            )
+        await self.execute_call(call, timeout)
+        await self.wait_for_call(call)
+        return call.is_ok
+
+    async def subscribe(self, event_type, handler, timeout=None):
+        call = await self._subscribe(
+            request={'type': 'subscribe_events', 'event_type': event_type},
+            handler=handler,
+            description=f'Subscribing to: {event_type} with handler {str(handler)}',
+            timeout=timeout
+            )
+        return call.data
+
+    async def subscribe_entities(self, entity_ids, handler, timeout=None):
+        """Subscribe to compressed state updates for a set of entities
+
+        The handler first receives a snapshot of all entities,
+        then diffs as they change.
+        """
+        call = await self._subscribe(
+            request={'type': 'subscribe_entities', 'entity_ids': list(entity_ids)},
+            handler=handler,
+            description=f'Subscribing to {len(entity_ids)} entities with handler {str(handler)}',
+            timeout=timeout
+            )
+        return call.data
+
+    async def subscribe_trigger(self, trigger, handler, timeout=None):
+        """Subscribe to a trigger evaluated by Home Assistant
+
+        The handler receives an event each time the trigger fires,
+        with the trigger variables in event.variables.trigger.
+        Raises SubscriptionError if Home Assistant rejects the
+        trigger, as versions without subscribe_trigger do.
+        """
+        call = await self._subscribe(
+            request={'type': 'subscribe_trigger', 'trigger': trigger},
+            handler=handler,
+            description=f'Subscribing to {trigger["platform"]} trigger with handler {str(handler)}',
+            timeout=timeout
+            )
+        if not call.is_ok:
+            # a rejected subscription must not be replayed on reconnect
+            self.subscriptions.pop(call.identity, None)
+            self.subscription_requests.pop(call.identity, None)
+            raise SubscriptionError(f'{call}: {call.response.get("error")}')
+        return call.data
+
+    async def _subscribe(self, request, handler, description, timeout=None):
+        """Subscribe and record the request so it can be replayed
+
+        Returns the completed call.
+        """
+        await self._authenticated.wait()
         identity = next(self.identity)
         self.subscriptions[identity] = handler
+        self.subscription_requests[identity] = request
         call = Call(
             identity=identity,
-            request={'type': 'subscribe_events', 'event_type': event_type, 'id': identity},
-            description=f'Subscribing to: {event_type} with handler {str(handler)}'
+            request=dict(request, id=identity),
+            description=description
             )
-        await self.execute_call(call)
-        await call.wait_for_complete()
-        return call.data
+        await self.execute_call(call, timeout)
+        await self.wait_for_call(call)
+        return call
 
-    async def call_service(self, domain, service, data={}):
-        identity = next(self.identity)
+    async def call_service(self, domain, service, data={}, timeout=None, blocking=True,
+                           network=None):
+        """Call a service and return its result
+
+        With blocking=False the Call is returned as soon as it is
+        written, so several calls go out back to back without
+        waiting for each other. Wait for them with join().
+
+        The call waits for a free slot of its network, or of its
+        domain if it has none, when that key has a limit.
+        """
+        semaphore = await self.limiter.acquire(network or domain)
 
         res = {
             "type": "call_service",
             "domain": domain,
-            "service": service,
-            'id': identity
+            "service": service
         }
         res.update(data)
 
         call = Call(
-            identity=identity,
+            identity=None,
             request=res,
             description=f'Calling service: {domain}.{service}'
             )
 
-        await self.execute_call(call)
-        await call.wait_for_complete()
+        if semaphore:
+            call.add_done_callback(lambda call: semaphore.release())
+
+        try:
+            if self.batcher and self.batcher.batchable(data):
+                self.batcher.add(call, timeout)
+            else:
+                await self.execute_call(call, timeout)
+        except:
+            if semaphore:
+                semaphore.release()
+            raise
+        if not blocking:
+            return call
+        await self.wait_for_call(call)
         return call.data
     
-    async def get_states(self):
-        identity = next(self.identity)
+    async def get_states(self, timeout=None):
         res = {
-            "id": identity,
             "type": "get_states"
         }
 
         call = Call(
-            identity=identity,
+            identity=None,
             request=res,
             description=f'Getting states'
             )
-        await self.execute_call(call)
-        await call.wait_for_complete()
+        await self.execute_call(call, timeout)
+        await self.wait_for_call(call)
         return call.data
 
-    async def execute_call(self, call):
+    async def execute_call(self, call, timeout=None, websocket=None):
+        """Send the request of call, over websocket if given
+
+        Otherwise service calls go over the command connection
+        when it is up, and everything else over the main one.
+
+        A call without an identity gets the next one here, right
+        before it is written, as Home Assistant rejects ids that
+        are not higher than the last one it saw. Requests on the
+        main connection wait until it is authenticated.
+        """
+        if websocket is None:
+            websocket = self._websocket_for(call)
+        if websocket is self.ws and call.request.get('type') != 'auth':
+            await self._authenticated.wait()
+        if call.identity is None:
+            call.assign(next(self.identity))
         logger.debug(f'Executing call [{call}]')
-        self.calls[call.identity] = call
-        await self.ws.send(call.request)
+        call.connection = COMMAND_CONNECTION if websocket is self.command_ws else MAIN_CONNECTION
+        self.calls.add(call, timeout)
+        try:
+            call.sent()
+            await websocket.send(call.request)
+        except:
+            self.calls.discard(call.identity)
+            raise
+
+    def _websocket_for(self, call):
+        if self._command_ready and call.request.get('type') == 'call_service':
+            return self.command_ws
+        return self.ws
+
+    async def wait_for_call(self, call):
+        """Wait for the result of an executed call
+
+        Raises CallTimeoutError if the call timed out. If the
+        waiting task is cancelled the call is dropped from the
+        pending table and failed, so its done callbacks, such as
+        the release of a limiter slot, still run.
+        """
+        try:
+            await call.wait_for_complete()
+        except asyncio.CancelledError:
+            self.calls.discard(call.identity)
+            if not call.is_complete:
+                call.fail(error_result(
+                    call.identity, CANCELLED, 'The waiting task was cancelled'))
+            raise
+
+        check_timeout(call)
+        return call
 
 
     async def handle_event(self, data):
 
         # check for auth event
-        if data['type'] == 'auth_ok':
+        if data['type'] in ('auth_ok', 'auth_invalid'):
             return self.auth_handler(data)
 
         # check for result event
@@ -190,32 +690,563 @@ class Client:
             
     def result_handler(self, data):
         try:
-            call = self.calls[data['id']]
-            if data['success'] == True:
-                call.complete(data)
-            else:
-                call.fail(data)
+            call = self.calls.pop(data['id'])
         except KeyError:
             logger.warning(f'No call registered for result with id {data["id"]}')
             if data['success'] == True:
                 logger.debug(data)
             else:
                 logger.error(data)
+            return
 
-    def auth_handler(self, data):
+        if data['success'] == True:
+            call.complete(data)
+        else:
+            call.fail(data)
+        self._observe(call)
+
+    def auth_handler(self, data, identity=ReservedIdentities.AUTH.value):
+
+        try:
+            call = self.calls.pop(identity)
+        except KeyError:
+            logger.warning(f'No call registered for authentication')
+            return
 
         if data['type'] == 'auth_ok':
-            try:
-                call = self.calls[ReservedIdentities.AUTH.value]
-                call.complete(data)
+            call.complete(data)
+        else:
+            call.fail(data)
+        self._observe(call)
 
-            except KeyError:
-                logger.warning(f'No call registered for authentication')
+    def _observe(self, call):
+        if call.round_trip is not None:
+            self.latency[call.kind].observe(call.round_trip)
+            self.connection_latency[call.connection].observe(call.round_trip)
 
     def undefined_type_handler(self, data):
         logger.info(f'Unhandled datapackage: {data}')
 
 
+class PendingCalls:
+    """Table of calls waiting for a result
+
+    Calls are removed as soon as they resolve. A call still
+    pending after its timeout is removed and failed with a
+    timeout error.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.expired = 0
+        self._calls = dict()
+        self._added = dict()
+        self._timers = dict()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, identity):
+        return identity in self._calls
+
+    @property
+    def oldest_age(self):
+        """Seconds the oldest pending call has waited, None if empty"""
+        if not self._added:
+            return None
+        return hass_ae.clock.get_clock().time() - min(self._added.values())
+
+    def add(self, call, timeout=None):
+        clock = hass_ae.clock.get_clock()
+        self.discard(call.identity)
+        self._calls[call.identity] = call
+        self._added[call.identity] = clock.time()
+
+        timeout = self.timeout if timeout is None else timeout
+        if timeout:
+            self._timers[call.identity] = clock.call_later(
+                timeout, self._expire, call.identity, timeout)
+
+    def pop(self, identity):
+        call = self._calls.pop(identity)
+        del self._added[identity]
+        timer = self._timers.pop(identity, None)
+        if timer:
+            timer.cancel()
+        return call
+
+    def discard(self, identity):
+        try:
+            return self.pop(identity)
+        except KeyError:
+            return None
+
+    def clear(self, match=None):
+        """Remove and return all pending calls, or those match
+        returns true for
+        """
+        return [
+            self.pop(identity) for identity, call in list(self._calls.items())
+            if match is None or match(call)]
+
+    def _expire(self, identity, timeout):
+        call = self.discard(identity)
+        if call:
+            self.expired += 1
+            call.fail(error_result(
+                identity, TIMEOUT, f'No result within {timeout} seconds'))
+
+
+class CallLimiter:
+    """Limits concurrent service calls per key
+
+    The key is the network tag of a component or the domain of
+    the service. A call holds a slot of its key from being sent
+    until its result arrives. The time calls wait for a slot is
+    collected per key in wait.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(limits or {})
+        self.wait = defaultdict(hass_ae.metrics.Histogram)
+        self._semaphores = dict()
+
+    async def acquire(self, key):
+        """Wait for a slot, returns the semaphore to release or
+        None if the key is unlimited
+        """
+        limit = self.limits.get(key)
+        if not limit:
+            return None
+
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = self._semaphores[key] = asyncio.Semaphore(limit)
+
+        clock = hass_ae.clock.get_clock()
+        start = clock.time()
+        await semaphore.acquire()
+        self.wait[key].observe(clock.time() - start)
+        return semaphore
+
+    def report(self):
+        return {key: histogram.report() for key, histogram in self.wait.items()}
+
+
+class CallBatcher:
+    """Merges service calls issued in the same loop iteration
+
+    Calls with the same domain, service, service data and timeout
+    that target a single entity each are sent as one call_service
+    with a list of entity ids. Every caller keeps its own Call,
+    resolved with the result of the merged call. merged counts the
+    requests saved. Calls get their identity when they are sent,
+    so ids keep increasing on the wire.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.merged = 0
+        self._batches = dict()
+
+    @staticmethod
+    def batchable(data):
+        return (data.keys() == {'service_data'}
+                and isinstance(data['service_data'].get('entity_id'), str))
+
+    def add(self, call, timeout=None):
+        request = call.request
+        service_data = dict(request['service_data'])
+        del service_data['entity_id']
+        key = (request['domain'], request['service'],
+               json.dumps(service_data, sort_keys=True), timeout)
+
+        if not self._batches:
+            asyncio.create_task(self._flush())
+        self._batches.setdefault(key, []).append(call)
+
+    async def _flush(self):
+        batches, self._batches = self._batches, dict()
+        for (*_, timeout), calls in batches.items():
+            # calls cancelled while waiting for the flush are not sent
+            calls = [call for call in calls if not call.is_complete]
+            if not calls:
+                continue
+            if len(calls) == 1:
+                call = calls[0]
+            else:
+                call = BatchCall(calls)
+                self.merged += len(calls) - 1
+
+            try:
+                await self.client.execute_call(call, timeout)
+            except Exception as e:
+                call.fail(error_result(call.identity, SEND_FAILED, str(e)))
+
+
+class EventDispatcher:
+    """Routes events to handlers by routing key
+
+    Holds a single Home Assistant subscription per event type
+    and hands each event only to the handlers registered for
+    its key (see ROUTING_KEYS), plus any handlers registered
+    for all events of that type.
+
+    State changes of single entities can instead be filtered by
+    Home Assistant with a state trigger, see register_state.
+    """
+
+    def __init__(self, client, triggers=False):
+        self.client = client
+        self.triggers = triggers
+        self._routes = defaultdict(lambda: defaultdict(list))
+        self._catch_all = defaultdict(list)
+        self._subscriptions = {}
+        self._trigger_routes = defaultdict(list)
+        self._trigger_subscriptions = {}
+        self._trigger_batch = None
+        self._trigger_flush = None
+
+    async def register(self, event_type, key, handler):
+        if event_type not in ROUTING_KEYS:
+            raise ValueError(f'No routing key defined for {event_type}')
+        self._routes[event_type][key].append(handler)
+        await self._ensure_subscribed(event_type)
+
+    async def register_all(self, event_type, handler):
+        self._catch_all[event_type].append(handler)
+        await self._ensure_subscribed(event_type)
+
+    async def _ensure_subscribed(self, event_type):
+        if event_type not in self._subscriptions:
+            self._subscriptions[event_type] = asyncio.ensure_future(
+                self.client.subscribe(event_type, self.dispatch))
+        await asyncio.shield(self._subscriptions[event_type])
+
+    async def register_state(self, entity_id, handler):
+        """Route state changes of entity_id to handler
+
+        With triggers enabled Home Assistant only sends the changes
+        of registered entities, through a state trigger shared by
+        all entities registered in the same loop iteration. The
+        handler gets them as state_changed events. If Home
+        Assistant rejects the trigger, or triggers are disabled,
+        the entity is routed from the state_changed subscription.
+
+        Triggers only pay off when nothing else subscribes to
+        state_changed. Otherwise every change of the entity is sent
+        twice, as a state_changed event and as a trigger event.
+        """
+        if not self.triggers:
+            return await self.register('state_changed', entity_id, handler)
+
+        self._trigger_routes[entity_id].append(handler)
+        if entity_id not in self._trigger_subscriptions:
+            if self._trigger_batch is None:
+                self._trigger_batch = []
+                self._trigger_flush = asyncio.ensure_future(
+                    self._subscribe_triggers(self._trigger_batch))
+            self._trigger_batch.append(entity_id)
+            self._trigger_subscriptions[entity_id] = self._trigger_flush
+        await asyncio.shield(self._trigger_subscriptions[entity_id])
+
+    async def _subscribe_triggers(self, entity_ids):
+        # entities registered from now on go in the next batch
+        self._trigger_batch = None
+        trigger = {'platform': 'state', 'entity_id': sorted(entity_ids)}
+        try:
+            await self.client.subscribe_trigger(trigger, self.dispatch_trigger)
+            return
+        except SubscriptionError as e:
+            logger.warning(f'State trigger rejected, falling back to state_changed: {e}')
+
+        self.triggers = False
+        for entity_id in entity_ids:
+            self._routes['state_changed'][entity_id].extend(
+                self._trigger_routes.pop(entity_id, []))
+        await self._ensure_subscribed('state_changed')
+
+    def handlers(self, event_type, key):
+        return self._routes[event_type].get(key, []) + self._catch_all[event_type]
+
+    async def dispatch(self, data, client):
+        if isinstance(data, hass_ae.codec.LazyMessage):
+            event_type, key = data.event_type, data.key
+        else:
+            event_type = data['event']['event_type']
+            key = routing_key(event_type, data)
+
+        handlers = self.handlers(event_type, key)
+        if not handlers:
+            logger.debug(f'No handler for {event_type} with key {key}, discarding')
+            return
+        if len(handlers) == 1:
+            return await handlers[0](data, client)
+        await asyncio.gather(*(h(data, client) for h in handlers))
+
+    async def dispatch_trigger(self, data, client):
+        data = trigger_event(data)
+        handlers = self._trigger_routes.get(data['event']['data']['entity_id'], [])
+        await asyncio.gather(*(h(data, client) for h in handlers))
+
+
+class EventQueue:
+    """Bounded queue for inbound event frames
+
+    Frames are keyed by event type and routing key. When the
+    queue is full, put() either waits for room (BLOCK) or drops
+    the oldest queued frame for the same key, falling back to
+    the oldest frame overall (DROP_OLDEST). The Client never
+    lets its listener wait here, see Client._enqueue.
+
+    Frames put as lossless are never dropped, the queue rather
+    grows past maxsize. They are meant for subscribe_entities
+    diffs, which only make sense applied in full and in order.
+
+    Frames for one key are handed out strictly in order, one at
+    a time: get() claims the key and skips later frames for it
+    until the claiming worker has drained them through next().
+    """
+
+    def __init__(self, maxsize=1000, policy=OverflowPolicy.DROP_OLDEST):
+        self.maxsize = maxsize
+        self.policy = OverflowPolicy(policy)
+        self.dropped = 0
+        self.max_depth = 0
+        self.drop_callbacks = []
+        self._entries = deque()
+        self._by_key = defaultdict(deque)
+        self._active = set()
+        self._size = 0
+        self._getters = deque()
+        self._putters = deque()
+
+    @property
+    def depth(self):
+        return self._size
+
+    def full(self):
+        return self._size >= self.maxsize
+
+    def on_drop(self, callback):
+        """Register a function called with the key of every
+        dropped frame
+        """
+        self.drop_callbacks.append(callback)
+
+    def count_drop(self, key):
+        self.dropped += 1
+        for callback in self.drop_callbacks:
+            callback(key)
+
+    async def put(self, key, data, lossless=False):
+        while self.policy == OverflowPolicy.BLOCK and self.full():
+            await self._wait(self._putters)
+        self.put_nowait(key, data, lossless)
+
+    def put_nowait(self, key, data, lossless=False):
+        """Queue a frame without waiting for room
+
+        A full queue drops a frame as with DROP_OLDEST, whatever
+        the policy.
+        """
+        if self.full():
+            self._drop(key)
+
+        entry = _QueueEntry(key, data, lossless)
+        self._entries.append(entry)
+        self._by_key[key].append(entry)
+        self._size += 1
+        self.max_depth = max(self.max_depth, self._size)
+        self._wake(self._getters)
+
+    async def get(self):
+        """Claim the next key that is not being handled
+
+        Returns the key and its oldest frame. The caller must
+        call next() with the key until it returns None.
+        """
+        while True:
+            while not self._entries:
+                await self._wait(self._getters)
+            entry = self._entries.popleft()
+            # frames for a claimed key stay parked in _by_key
+            if entry.alive and entry.key not in self._active:
+                break
+
+        self._active.add(entry.key)
+        return entry.key, self._take(entry.key)
+
+    def next(self, key):
+        """Next frame for a claimed key, or None to release it"""
+        if key not in self._by_key:
+            self._active.discard(key)
+            return None
+        return self._take(key)
+
+    def _take(self, key):
+        entry = self._pop_key(key)
+        entry.alive = False
+        self._size -= 1
+        self._wake(self._putters)
+        return entry.data
+
+    def _drop(self, key):
+        if key not in self._by_key or self._by_key[key][0].lossless:
+            oldest = next((e for e in self._entries if e.alive and not e.lossless), None)
+            if oldest is not None:
+                key = oldest.key
+            else:
+                key = next((k for k, entries in self._by_key.items()
+                            if not entries[0].lossless), None)
+                if key is None:
+                    # only lossless frames are queued
+                    return
+        entry = self._pop_key(key)
+
+        entry.alive = False
+        entry.data = None
+        self._size -= 1
+        self.count_drop(entry.key)
+        logger.debug(f'Event queue full, dropped oldest event for {entry.key}')
+
+        # dropped entries are skipped lazily by get(), compact if they pile up
+        if len(self._entries) > 2 * self.maxsize:
+            self._entries = deque(e for e in self._entries if e.alive)
+
+    def _pop_key(self, key):
+        entries = self._by_key[key]
+        entry = entries.popleft()
+        if not entries:
+            del self._by_key[key]
+        return entry
+
+    async def _wait(self, waiters):
+        waiter = asyncio.get_event_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in waiters:
+                waiters.remove(waiter)
+            else:
+                # we were woken up, pass it on to the next waiter
+                self._wake(waiters)
+            raise
+
+    def _wake(self, waiters):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+
+class _QueueEntry:
+
+    __slots__ = ('key', 'data', 'lossless', 'alive')
+
+    def __init__(self, key, data, lossless=False):
+        self.key = key
+        self.data = data
+        self.lossless = lossless
+        self.alive = True
+
+
+async def join(calls):
+    """Wait for calls executed without blocking
+
+    Returns the data of each call in order. Raises
+    CallTimeoutError if any of them timed out.
+    """
+    calls = list(calls)
+    await asyncio.gather(*(call.wait_for_complete() for call in calls))
+    for call in calls:
+        check_timeout(call)
+    return [call.data for call in calls]
+
+
+def check_timeout(call):
+    if call.error_code == TIMEOUT:
+        raise CallTimeoutError(f'{call}: {call.response["error"]["message"]}')
+
+
+def error_result(identity, code, message):
+    """Result frame for a call failed by the client itself"""
+    return {
+        'id': identity,
+        'type': 'result',
+        'success': False,
+        'error': {'code': code, 'message': message}
+        }
+
+
+def routing_key(event_type, data):
+    try:
+        return ROUTING_KEYS[event_type](data)
+    except (KeyError, TypeError):
+        return None
+
+
+def trigger_event(data):
+    """state_changed event of a state trigger event"""
+    event = data['event']
+    trigger = event['variables']['trigger']
+    return {
+        'id': data['id'],
+        'type': 'event',
+        'event': {
+            'event_type': 'state_changed',
+            'data': {
+                'entity_id': trigger['entity_id'],
+                'old_state': trigger.get('from_state'),
+                'new_state': trigger.get('to_state')
+            },
+            'context': event.get('context')
+        }
+    }
+
+
+def is_entity_diff(data):
+    """Whether a frame is a subscribe_entities message"""
+    if isinstance(data, hass_ae.codec.LazyMessage):
+        return False
+    try:
+        event = data['event']
+        return bool(event) and not event.keys() - ENTITY_DIFF_KEYS
+    except (KeyError, TypeError, AttributeError):
+        return False
+
+
+def queue_key(data):
+    """Key used to group a frame on the event queue"""
+    if isinstance(data, hass_ae.codec.LazyMessage):
+        return (data.event_type, data.key)
+    try:
+        event = data['event']
+        if 'variables' in event:
+            # state triggers keep order with the entity's state_changed events
+            return ('state_changed', event['variables']['trigger']['entity_id'])
+        event_type = event['event_type']
+    except (KeyError, TypeError):
+        # events without a type, such as entity diffs, keep order per subscription
+        return (data.get('type'), data.get('id'))
+    return (event_type, routing_key(event_type, data))
+
+
+class Error(Exception):
+    pass
+
+class AuthenticationError(Error):
+    pass
+
+class CallTimeoutError(Error):
+    pass
+
+class SubscriptionError(Error):
+    pass
+
+
 def identity():
     """Identity value generator
 
@@ -235,6 +1266,11 @@ class Call:
         self._identity = identity
         self._response = None
         self._description = description
+        self._future = asyncio.get_event_loop().create_future()
+        self._sent_at = None
+        self._round_trip = None
+        # Connection the request was sent over, set by Client.execute_call
+        self.connection = None
 
     @property
     def is_complete(self):
@@ -264,63 +1300,433 @@ class Call:
     def description(self):
         return self._description
 
+    @property
+    def kind(self):
+        """Service for call_service requests, the request type otherwise"""
+        if self._request.get('type') == 'call_service':
+            return f'{self._request["domain"]}.{self._request["service"]}'
+        return self._request.get('type')
+
+    @property
+    def error_code(self):
+        if self._is_ok or not self._response:
+            return None
+        return (self._response.get('error') or {}).get('code')
+
+    @property
+    def round_trip(self):
+        """Seconds from sending the request to its result"""
+        return self._round_trip
+
+    def sent(self):
+        self._sent_at = hass_ae.clock.get_clock().time()
+
+    def assign(self, identity):
+        """Set the identity of a call that has none yet"""
+        self._identity = identity
+        self._request['id'] = identity
+
+    def add_done_callback(self, callback):
+        """Call callback with the call once it completes or fails"""
+        self._future.add_done_callback(lambda future: callback(self))
+
     def complete(self, payload):
         self._is_complete = True
         self._is_ok = True
         self._response = payload
+        self._resolve()
         logger.debug(f'Completed call [{self}]')
 
     def fail(self, payload):
         self._is_complete = True
         self._is_ok = False
         self._response = payload
+        self._resolve()
+        if self.error_code == CANCELLED:
+            logger.debug(f'Cancelled call [{self}]')
+            return
         logger.error(f'Failed call [{self}]')
         logger.error(f'Call {self.identity} - {self.description} failed, \n {self.request} \n {self.response}')
 
+    def _resolve(self):
+        if self._sent_at is not None:
+            self._round_trip = hass_ae.clock.get_clock().time() - self._sent_at
+        if not self._future.done():
+            self._future.set_result(self._response)
+
     async def wait_for_complete(self):
-        while True:
-            if self.is_complete:
-                return
-            await asyncio.sleep(0.1)
+        await asyncio.shield(self._future)
 
     
     def __repr__(self):
         return f'Call {self.identity} - {self.description}'
 
+class BatchCall(Call):
+    """Service call on the entities of several merged calls
+
+    Its result completes or fails each of the merged calls.
+    """
+
+    def __init__(self, calls):
+        first = calls[0].request
+        request = dict(first)
+        request['service_data'] = dict(
+            first['service_data'],
+            entity_id=[call.request['service_data']['entity_id'] for call in calls])
+        super().__init__(
+            identity=None,
+            request=request,
+            description=f'{calls[0].description} on {len(calls)} entities')
+        self.calls = calls
+
+    def sent(self):
+        super().sent()
+        for call in self.calls:
+            call.sent()
+
+    def complete(self, payload):
+        super().complete(payload)
+        for call in self.calls:
+            if not call.is_complete:
+                call.complete(payload)
+
+    def fail(self, payload):
+        super().fail(payload)
+        for call in self.calls:
+            if not call.is_complete:
+                call.fail(payload)
+
+
+class State:
+    """Compact record of an entity's state
+
+    value holds the state parsed once at update time: a bool
+    for on/off, a float for numeric states, None when the
+    entity is unavailable or unknown and the state string
+    otherwise.
+    """
+
+    __slots__ = ('entity_id', 'state', 'value', 'attributes',
+                 'last_changed', 'last_updated')
+
+    def __init__(self, entity_id, state, attributes=None,
+                 last_changed=None, last_updated=None):
+        self.entity_id = entity_id
+        self.state = sys.intern(str(state))
+        self.value = parse_state(self.state)
+        self.attributes = attributes or None
+        self.last_changed = last_changed
+        self.last_updated = last_updated
+
+    @classmethod
+    def from_raw(cls, data, attributes=TRACKED_ATTRIBUTES):
+        raw_attributes = data.get('attributes') or {}
+        return cls(
+            entity_id=data['entity_id'],
+            state=data['state'],
+            attributes={k: raw_attributes[k] for k in attributes if k in raw_attributes},
+            last_changed=parse_timestamp(data.get('last_changed')),
+            last_updated=parse_timestamp(data.get('last_updated'))
+            )
+
+    def attribute(self, name, default=None):
+        if not self.attributes:
+            return default
+        return self.attributes.get(name, default)
+
+    def __repr__(self):
+        return f'State {self.entity_id} - {self.state}'
+
+
+def parse_state(state):
+    if state == 'on':
+        return True
+    if state == 'off':
+        return False
+    if state in ('unavailable', 'unknown'):
+        return None
+    try:
+        return float(state)
+    except ValueError:
+        return state
+
+
+def parse_timestamp(value):
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
 class StateManager():
 
-    def __init__(self):
+    def __init__(self, coalesce_windows=None, attributes=TRACKED_ATTRIBUTES):
         self._states = dict()
         self._subscriptions = defaultdict(list)
+        self._coalesce_windows = dict(coalesce_windows or {})
+        self._pending = dict()
+        self._assumed = dict()
+        self.attributes = attributes
+        self.collapsed = defaultdict(int)
+        self.rolled_back = 0
+        self._live = False
+        self._synced_at = None
 
     @property
     def states(self):
         return self._states
+
+    @property
+    def synced_at(self):
+        """Clock time the states were last known to be in sync
+
+        The current time while a live subscription keeps them up
+        to date, the time that stopped otherwise. None before the
+        first snapshot.
+        """
+        if self._live:
+            return hass_ae.clock.get_clock().time()
+        return self._synced_at
+
+    def mark_synced(self):
+        """The states are complete and kept up to date from now on"""
+        self._live = True
+        self._synced_at = hass_ae.clock.get_clock().time()
+
+    def mark_unsynced(self):
+        """Updates may be missed from now on, e.g. on a lost connection"""
+        if self._live:
+            self._synced_at = hass_ae.clock.get_clock().time()
+        self._live = False
+
+    def frame_dropped(self, key):
+        """EventQueue drop callback, see EventQueue.on_drop
+
+        A dropped state change leaves the states behind until the
+        next snapshot.
+        """
+        if key[0] == 'state_changed':
+            self.mark_unsynced()
    
     def get(self, state, default=None):
-        return self._states.get(state, default)
-
-    async def update(self, state, value):
-        self._states[state] = value
-        logger.debug(f'{state} changed to {value}')
-        await self._notify_subscribers(state, value)
+        """Raw state string of an entity"""
+        record = self._states.get(state)
+        if record is None:
+            return default
+        return record.state
+
+    def get_state(self, state):
+        """State record of an entity, None if it is unknown"""
+        return self._states.get(state)
+
+    def is_pending(self, state):
+        """Whether the state of an entity is assumed and not yet confirmed"""
+        return state in self._assumed
+
+    def assume(self, record, timeout):
+        """Set the state an entity is expected to get
+
+        Meant for the result of an acknowledged service call, so
+        readers see it before Home Assistant reports the change.
+        Subscribers are not notified. The next update of the entity
+        replaces it; without one within timeout seconds the
+        confirmed state is restored.
+        """
+        state = record.entity_id
+        confirmed = self._settle(state)
+        self._states[state] = record
+        timer = hass_ae.clock.get_clock().call_later(timeout, self._roll_back, state)
+        self._assumed[state] = (confirmed, timer)
+
+    def _settle(self, state):
+        """Drop an assumed state, returning the confirmed record"""
+        assumed = self._assumed.pop(state, None)
+        if assumed is not None:
+            confirmed, timer = assumed
+            timer.cancel()
+            if confirmed is None:
+                del self._states[state]
+            else:
+                self._states[state] = confirmed
+        return self._states.get(state)
+
+    def _roll_back(self, state):
+        logger.warning(f'{state} did not confirm its assumed state {self._states[state].state}, rolling back')
+        self.rolled_back += 1
+        self._settle(state)
+
+    def coalesce(self, key, window):
+        """Coalesce notifications for an entity_id or a whole domain
+
+        Subscribers are notified once, window seconds after the first
+        update, with the latest value. Updates in between are only
+        counted in collapsed. A window of None disables coalescing.
+        """
+        if window is None:
+            self._coalesce_windows.pop(key, None)
+        else:
+            self._coalesce_windows[key] = window
+
+    def coalesce_window(self, state):
+        window = self._coalesce_windows.get(state)
+        if window is None:
+            window = self._coalesce_windows.get(state.split('.', 1)[0])
+        return window
+
+    async def update(self, state, value, attributes=None,
+                     last_changed=None, last_updated=None):
+        await self.set_state(State(
+            entity_id=state,
+            state=value,
+            attributes=attributes,
+            last_changed=last_changed,
+            last_updated=last_updated
+            ))
+
+    async def set_state(self, record):
+        state = record.entity_id
+        self._settle(state)
+        self._states[state] = record
+        logger.debug(f'{state} changed to {record.state}')
+
+        window = self.coalesce_window(state)
+        if not window or not self._subscriptions.get(state):
+            await self._notify_subscribers(state, record.state)
+        elif state in self._pending:
+            self.collapsed[state] += 1
+        else:
+            self._pending[state] = asyncio.ensure_future(
+                self._notify_later(state, window))
+
+    async def _notify_later(self, state, window):
+        await hass_ae.clock.sleep(window)
+        del self._pending[state]
+        try:
+            await self._notify_subscribers(state, self._states[state].state)
+        except Exception:
+            logger.exception(f'Failure while notifying subscribers of {state}')
 
     def load(self, data):
-        self._states = self._parse_from_raw_states(data)
+        self._states = self._parse_from_raw_states(data, self.attributes)
+        self.mark_synced()
 
     @classmethod
-    def _parse_from_raw_states(cls, data):
-        return {d['entity_id']: d['state'] for d in data}
+    def _parse_from_raw_states(cls, data, attributes=TRACKED_ATTRIBUTES):
+        return {d['entity_id']: State.from_raw(d, attributes) for d in data}
 
     async def subscribe(self, state, callback):
         self._subscriptions[state].append(callback)
 
     async def _notify_subscribers(self, state, data):
-        for callback in self._subscriptions[state]:
+        for callback in self._subscriptions.get(state, []):
             await callback(data)
 
-    async def event_callback(self, data):
-        await self.update(
-            state=data['event']['data']['new_state']['entity_id'],
-            value=data['event']['data']['new_state']['state']
+    async def sync_entities(self, client, entity_ids):
+        """Keep states in sync through subscribe_entities
+
+        An alternative to load() and event_callback() limited to
+        entity_ids. Returns once the initial snapshot is applied.
+        """
+        synced = asyncio.get_event_loop().create_future()
+
+        async def _handler(data, client):
+            await self.entities_callback(data)
+            if not synced.done():
+                synced.set_result(None)
+
+        await client.subscribe_entities(sorted(entity_ids), _handler)
+        await synced
+
+    async def resync(self, data):
+        """Bring states up to date from a fresh get_states snapshot
+
+        Only entities whose state or attributes differ from the
+        cache notify subscribers.
+        """
+        records = self._parse_from_raw_states(data, self.attributes)
+        for entity_id in set(self._states) - set(records):
+            self._settle(entity_id)
+            self._states.pop(entity_id, None)
+        for record in records.values():
+            await self._merge(record)
+        self.mark_synced()
+
+    async def _merge(self, record):
+        known = self._settle(record.entity_id)
+        if known is None:
+            self._states[record.entity_id] = record
+            return
+
+        if known.last_updated and record.last_updated and known.last_updated > record.last_updated:
+            # an event newer than the snapshot was already applied
+            return
+
+        if known.state != record.state or known.attributes != record.attributes:
+            await self.set_state(record)
+        else:
+            self._states[record.entity_id] = record
+
+    async def entities_callback(self, data):
+        """Apply a compressed subscribe_entities message
+
+        Added entities that are already known only notify
+        subscribers if their state or attributes differ.
+        """
+        event = data['event']
+
+        for entity_id, compressed in event.get('a', {}).items():
+            await self._merge(self._from_compressed(entity_id, compressed))
+        if 'a' in event:
+            # the snapshot sent on (re)subscribing
+            self.mark_synced()
+
+        for entity_id, diff in event.get('c', {}).items():
+            known = self._settle(entity_id)
+            if known is None:
+                logger.warning(f'Change for unknown entity {entity_id}, discarding')
+                continue
+            await self.set_state(self._apply_diff(known, diff))
+
+        for entity_id in event.get('r', []):
+            self._settle(entity_id)
+            self._states.pop(entity_id, None)
+
+    def _from_compressed(self, entity_id, compressed):
+        raw_attributes = compressed.get('a') or {}
+        return State(
+            entity_id=entity_id,
+            state=compressed['s'],
+            attributes={k: raw_attributes[k] for k in self.attributes if k in raw_attributes},
+            last_changed=compressed.get('lc'),
+            last_updated=compressed.get('lu', compressed.get('lc'))
+            )
+
+    def _apply_diff(self, record, diff):
+        additions = diff.get('+', {})
+        removals = diff.get('-', {})
+
+        attributes = dict(record.attributes or {})
+        changed = additions.get('a') or {}
+        attributes.update({k: changed[k] for k in self.attributes if k in changed})
+        for name in removals.get('a', []):
+            attributes.pop(name, None)
+
+        last_changed = additions.get('lc', record.last_changed)
+        return State(
+            entity_id=record.entity_id,
+            state=additions.get('s', record.state),
+            attributes=attributes,
+            last_changed=last_changed,
+            last_updated=additions.get('lu', additions.get('lc', record.last_updated))
             )
+
+    async def event_callback(self, data):
+        new_state = data['event']['data']['new_state']
+        if new_state is None:
+            self._settle(data['event']['data']['entity_id'])
+            self._states.pop(data['event']['data']['entity_id'], None)
+            return
+
+        await self.set_state(State.from_raw(new_state, self.attributes))
@@ -0,0 +1,128 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Clock:
+    """Source of time for everything in hass_ae that waits
+
+    time() is monotonic seconds, used for deadlines and durations.
+    now() is seconds since the epoch, comparable with the
+    timestamps Home Assistant reports.
+    """
+
+    def time(self):
+        return asyncio.get_event_loop().time()
+
+    def now(self):
+        return time.time()
+
+    def call_later(self, delay, callback, *args):
+        return asyncio.get_event_loop().call_later(delay, callback, *args)
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay)
+
+
+class VirtualClock(Clock):
+    """Clock that only moves when advanced
+
+    Timers and sleeps are kept until advance() passes their
+    deadline, so hours of automation run in as long as the
+    handlers take. Between deadlines the event loop is left to
+    run whatever became ready.
+    """
+
+    # Event loop iterations given to ready tasks after each step
+    SETTLE_ITERATIONS = 50
+
+    def __init__(self, start=None):
+        self._time = 0.0
+        self._epoch = time.time() if start is None else start
+        self._timers = []
+        self._counter = itertools.count()
+
+    def time(self):
+        return self._time
+
+    def now(self):
+        return self._epoch + self._time
+
+    def call_later(self, delay, callback, *args):
+        handle = VirtualTimerHandle(self._time + max(delay, 0), callback, args)
+        heapq.heappush(self._timers, (handle.deadline, next(self._counter), handle))
+        return handle
+
+    async def sleep(self, delay):
+        future = asyncio.get_event_loop().create_future()
+        handle = self.call_later(delay, _resolve, future)
+        try:
+            await future
+        finally:
+            handle.cancel()
+
+    async def advance(self, seconds):
+        """Move time forward, running everything due on the way"""
+        target = self._time + seconds
+        await self.settle()
+        while self._timers and self._timers[0][0] <= target:
+            deadline, _, handle = heapq.heappop(self._timers)
+            if handle.cancelled:
+                continue
+            self._time = max(self._time, deadline)
+            handle.run()
+            await self.settle()
+        self._time = target
+
+    async def settle(self):
+        """Let tasks that are ready run, without moving time"""
+        for _ in range(self.SETTLE_ITERATIONS):
+            await asyncio.sleep(0)
+
+
+class VirtualTimerHandle:
+
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            self.callback(*self.args)
+        except Exception:
+            logger.exception(f'Failure in timer callback {self.callback}')
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+_clock = Clock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    """Replace the clock used by hass_ae, returns the previous one"""
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+async def sleep(delay):
+    """asyncio.sleep on the current clock"""
+    await _clock.sleep(delay)
@@ -0,0 +1,154 @@
+"""Json encoding of websocket messages
+
+orjson is used when it is installed, the json module otherwise.
+
+Event frames can be decoded lazily: the id, event type and
+routing key are read from the start of the frame with an anchored
+regular expression, and the rest is only parsed once something
+reads the message. Home Assistant writes these fields first, so
+frames match unless they are arrays of coalesced messages, which
+are decoded as usual. With coalesce_messages enabled, which is the
+default, Home Assistant packs events into arrays whenever several
+are sent together, so under load few frames are decoded lazily.
+"""
+
+import json
+import logging
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+class JsonCodec:
+
+    name = 'json'
+
+    def loads(self, message):
+        return json.loads(message)
+
+    def dumps(self, data):
+        return json.dumps(data)
+
+
+class OrjsonCodec(JsonCodec):
+
+    name = 'orjson'
+
+    def loads(self, message):
+        return orjson.loads(message)
+
+    def dumps(self, data):
+        return orjson.dumps(data).decode()
+
+
+def get_codec(name='auto'):
+    """Codec by name: json, orjson, or auto for the fastest available"""
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise RuntimeError('orjson codec requested but orjson is not installed')
+        return OrjsonCodec()
+    if name == 'json':
+        return JsonCodec()
+    raise ValueError(f'Unknown json codec {name}')
+
+
+# {"id": 5, "type": "event", "event": {"event_type": "state_changed",
+#  "data": {"entity_id": "light.l_tf_1", ...
+EVENT_HEADER = re.compile(
+    r'\{\s*"id"\s*:\s*(\d+)\s*,\s*"type"\s*:\s*"event"\s*,'
+    r'\s*"event"\s*:\s*\{\s*"event_type"\s*:\s*"([^"\\]+)"\s*,'
+    r'\s*"data"\s*:\s*\{\s*"(entity_id|id)"\s*:\s*"([^"\\]*)"')
+
+# Field of the event data holding the routing key, per event type
+ROUTING_FIELDS = {
+    'state_changed': 'entity_id',
+    'deconz_event': 'id',
+}
+
+
+class LazyMessage:
+    """Event message decoded on first access
+
+    type, id, event_type and key (the routing key) are available
+    without decoding. Reading anything else decodes the frame.
+    """
+
+    __slots__ = ('raw', 'codec', 'id', 'event_type', 'key', '_data')
+
+    type = 'event'
+
+    def __init__(self, raw, codec, id_, event_type, key):
+        self.raw = raw
+        self.codec = codec
+        self.id = id_
+        self.event_type = event_type
+        self.key = key
+        self._data = None
+
+    @classmethod
+    def parse(cls, raw, codec):
+        """LazyMessage of an event frame, None if the frame doesn't
+        start the way Home Assistant writes events
+        """
+        match = EVENT_HEADER.match(raw)
+        if match is None:
+            return None
+
+        id_, event_type, field, value = match.groups()
+        routing_field = ROUTING_FIELDS.get(event_type)
+        if routing_field is not None and routing_field != field:
+            return None
+        return cls(raw, codec, int(id_), event_type, value if routing_field else None)
+
+    @property
+    def is_decoded(self):
+        return self._data is not None
+
+    def decode(self):
+        if self._data is None:
+            self._data = self.codec.loads(self.raw)
+        return self._data
+
+    def __getitem__(self, name):
+        if name == 'type':
+            return self.type
+        if name == 'id':
+            return self.id
+        return self.decode()[name]
+
+    def get(self, name, default=None):
+        if name in ('type', 'id'):
+            return self[name]
+        return self.decode().get(name, default)
+
+    def __contains__(self, name):
+        return name in self.decode()
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def __bool__(self):
+        # an event is never empty, and truth testing must not decode it
+        return True
+
+    def keys(self):
+        return self.decode().keys()
+
+    def items(self):
+        return self.decode().items()
+
+    def values(self):
+        return self.decode().values()
+
+    def __repr__(self):
+        return f'LazyMessage {self.id} {self.event_type} {self.key}'
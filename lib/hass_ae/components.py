@@ -3,7 +3,11 @@ import enum
 import logging
 import abc
 import asyncio
+import hass_ae.client
+import hass_ae.clock
 import hass_ae.domain
+import hass_ae.metrics
+import hass_ae.scheduler
 from hass_ae.handlers import BooleanStateChangedHandler
 import sys, inspect
 
@@ -29,9 +33,12 @@ class ComponentRegistrySection():
 
 class ComponentRegistry():
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, timings=None, **kwargs):
         self._reg = dict()
         self.sections = dict()
+        self.entity_ids = set()
+        self.timings = timings or hass_ae.metrics.PhaseTimer()
+        self._before_subscribe = []
         
     def register(self, components):
         for component in components:
@@ -39,34 +46,90 @@ class ComponentRegistry():
             if not key in self.sections.keys():
                 self.sections[key] = ComponentRegistrySection(type(component))
             self.sections[key].register(component)
+            if component.HAS_STATE:
+                self.entity_ids.add(component.full_identity)
 
     def get(self, type_, alias):
         return self.sections[type_.__name__].get(alias)
 
+    def before_subscribe(self, callback):
+        """Register a coroutine function called with the registry
+        at the start of subscribe_all
+        """
+        self._before_subscribe.append(callback)
+
     async def subscribe_all(self):
-        for k, s in self.sections.items():
-            for k, c in s.components.items():
-                try:
-                    logger.debug(f'trying to subscribe {k}')
-                    await c.subscribe()
-                except TypeError:
-                    logger.exception(
-                        f'{k} failed to subscribe')
+        """Subscribe all components
+
+        The components subscribe concurrently, so every request is
+        sent before any acknowledgement is awaited.
+        """
+        for callback in self._before_subscribe:
+            await callback(self)
+
+        async def _subscribe(k, c):
+            try:
+                logger.debug(f'trying to subscribe {k}')
+                await c.subscribe()
+            except TypeError:
+                logger.exception(
+                    f'{k} failed to subscribe')
+
+        with self.timings.phase('subscribe'):
+            await asyncio.gather(*(
+                _subscribe(k, c)
+                for s in self.sections.values()
+                for k, c in s.components.items()))
 
 
 class Component(abc.ABC):
 
     DOMAIN = hass_ae.domain.UNDEFINED
-
-    def __init__(self, identity, alias, client, *args, **kwargs):
+    # Whether the component is a Home Assistant entity with a state
+    HAS_STATE = False
+    # Minimum seconds between service calls, see CommandChannel.
+    # Overridden per domain by the client's command_intervals.
+    COMMAND_INTERVAL = None
+
+    def __init__(self, identity, alias, client, *args, command_interval=None, network=None,
+                 **kwargs):
         self.identity = identity
         self.alias = alias
+        # Radio network the device is on, see hass_ae.client.CallLimiter
+        self.network = network
         self.full_identity = f'{self.DOMAIN}.{self.identity}'
         self.client = client
+        if command_interval is None:
+            command_interval = client.command_intervals.get(self.DOMAIN, self.COMMAND_INTERVAL)
+        self.commands = CommandChannel(command_interval) if command_interval else None
 
     async def subscribe(self):
         logger.debug(f'Subription of {type(self).__name__}[{self.alias}] is a no-op')
 
+    async def call_service(self, service, service_data=None, blocking=True):
+        """Call a service of the component's domain on this entity
+
+        With blocking=False the call is returned as soon as it is
+        sent, see hass_ae.client.join. With a command interval set
+        the call goes through the component's command channel. There
+        a non-blocking call that has to wait for its turn returns
+        None right away, so a newer call can still replace it.
+        """
+        if self.commands is None:
+            return await self._call_service(service, service_data, blocking)
+        return await self.commands.submit(
+            lambda: self._call_service(service, service_data, blocking), wait=blocking)
+
+    async def _call_service(self, service, service_data=None, blocking=True):
+        data = {"entity_id": self.full_identity}
+        data.update(service_data or {})
+        return await self.client.call_service(
+            domain=self.DOMAIN,
+            service=service,
+            data={"service_data": data},
+            blocking=blocking,
+            network=self.network)
+
     def __repr__(self):
         return f'{self.full_identity}|{self.alias}:'
 
@@ -88,7 +151,8 @@ class TFSwitch(Component):
         self.handler = handler
 
     async def subscribe(self):
-        await self.client.subscribe('deconz_event', self.evaluate)
+        await self.client.dispatcher.register(
+            'deconz_event', self.identity, self.evaluate)
 
     async def check_event(self, data):
         id_ = data['event']['data']['id']
@@ -120,14 +184,14 @@ class TFSwitch(Component):
 class TFMotionSensor(Component):
 
     DOMAIN = hass_ae.domain.BINARY_SENSOR
+    HAS_STATE = True
 
     def __init__(self, handler, **kwargs):
         super().__init__(**kwargs)
         self.handler = handler
 
     async def subscribe(self):
-        await self.client.subscribe('state_changed', self.evaluate)
-
+        await self.client.dispatcher.register_state(self.full_identity, self.evaluate)
 
     async def check_event(self, data):
         event_identity = data['event']['data']['entity_id']
@@ -150,40 +214,138 @@ class TFMotionSensor(Component):
         return await fn()
 
 class BoolenStateEntity(Component):
+    """Entity with an on/off state
+
+    With suppress_redundant set, turn_on and turn_off are skipped
+    when the cached state already matches. A stale cache can't hold
+    back a command for long: one is always sent if the entity had
+    none sent in the last REFRESH_INTERVAL seconds, or if the state
+    manager stopped being in sync longer ago than that, e.g. on a
+    lost connection or a dropped state change. Assumed states that
+    are not confirmed yet never suppress a command. Skipped and
+    sent commands are counted in suppressed and sent.
+
+    With optimistic set, the state a turn_on or turn_off results in
+    is assumed in the state manager once the call is acknowledged,
+    until Home Assistant reports the change or ASSUME_TIMEOUT
+    seconds pass.
+    """
 
     DOMAIN = hass_ae.domain.UNDEFINED
+    HAS_STATE = True
+    REFRESH_INTERVAL = 300
+    ASSUME_TIMEOUT = 5
 
-    def __init__(self, state_manager, handler=None,  **kwargs):
+    # Services with a known resulting state
+    TARGET_STATES = {'turn_on': True, 'turn_off': False}
+
+    def __init__(self, state_manager, handler=None, suppress_redundant=False,
+                 optimistic=False, **kwargs):
         self.handler = handler
         self.state_manager = state_manager
+        self.suppress_redundant = suppress_redundant
+        self.optimistic = optimistic
+        self.sent = 0
+        self.suppressed = 0
+        self._sent_at = None
         super().__init__(**kwargs)
 
-    async def set_state(self, state:bool=True):
+    async def _call_service(self, service, service_data=None, blocking=True):
+        if self.is_redundant(service, service_data):
+            logger.debug(f'Suppressed {service} of {self.full_identity}|{self.alias}, state is unchanged')
+            self.suppressed += 1
+            call = hass_ae.client.Call(
+                identity=None,
+                request={'service': service, 'service_data': service_data},
+                description=f'Suppressed service: {self.DOMAIN}.{service}')
+            call.complete({'result': None})
+            return call.data if blocking else call
+
+        self.sent += 1
+        self._sent_at = hass_ae.clock.get_clock().time()
+        if not self.optimistic or service not in self.TARGET_STATES:
+            return await super()._call_service(service, service_data, blocking=blocking)
+
+        known = self.state_manager.get_state(self.full_identity)
+        call = await super()._call_service(service, service_data, blocking=False)
+        if not blocking:
+            asyncio.create_task(self._assume_when_complete(call, known, service, service_data))
+            return call
+
+        await self.client.wait_for_call(call)
+        self._assume(call, known, service, service_data)
+        return call.data
+
+    async def _assume_when_complete(self, call, known, service, service_data):
+        await call.wait_for_complete()
+        self._assume(call, known, service, service_data)
+
+    def _assume(self, call, known, service, service_data):
+        if not call.is_ok:
+            return
+        if self.state_manager.get_state(self.full_identity) is not known:
+            # the change was reported before the acknowledgement
+            return
+
+        on = self.TARGET_STATES[service]
+        attributes = None
+        if on:
+            attributes = dict(known.attributes or {}) if known else {}
+            attributes.update(self.target_attributes(service_data or {}))
+
+        now = hass_ae.clock.get_clock().now()
+        changed = known is None or known.value is not on
+        self.state_manager.assume(hass_ae.client.State(
+            entity_id=self.full_identity,
+            state='on' if on else 'off',
+            attributes=attributes,
+            last_changed=now if changed else known.last_changed,
+            last_updated=now
+            ), self.ASSUME_TIMEOUT)
+
+    def is_redundant(self, service, service_data=None):
+        """Whether the cached state already is the result of service"""
+        if not self.suppress_redundant or service not in self.TARGET_STATES:
+            return False
+        if self.state_manager.is_pending(self.full_identity):
+            return False
+
+        record = self.state_manager.get_state(self.full_identity)
+        if record is None or record.value is not self.TARGET_STATES[service]:
+            return False
+
+        for name, value in self.target_attributes(service_data or {}).items():
+            if record.attribute(name) != value:
+                return False
+
+        now = hass_ae.clock.get_clock().time()
+        synced_at = self.state_manager.synced_at
+        if self._sent_at is None or synced_at is None:
+            return False
+        return (now - self._sent_at < self.REFRESH_INTERVAL
+                and now - synced_at < self.REFRESH_INTERVAL)
+
+    def target_attributes(self, service_data):
+        """Attributes service_data sets, as the state reports them"""
+        return {}
+
+    async def set_state(self, state:bool=True, blocking=True):
         if state:
-            await self.turn_on()
+            return await self.turn_on(blocking=blocking)
         else:
-            await self.turn_off()
+            return await self.turn_off(blocking=blocking)
 
-    async def turn_on(self):
+    async def turn_on(self, blocking=True):
         logger.info(f'Turning on {self.full_identity}|{self.alias}')
-        await self.client.call_service(
-            domain=self.DOMAIN,
-            service='turn_on',
-            data={"service_data": {"entity_id": self.full_identity}})
+        return await self.call_service('turn_on', blocking=blocking)
 
-    async def turn_off(self):
+    async def turn_off(self, blocking=True):
         logger.info(f'Turning off {self.full_identity}|{self.alias}')
-        await self.client.call_service(
-            domain=self.DOMAIN,
-            service='turn_off',
-            data={"service_data": {"entity_id": self.full_identity}})
+        return await self.call_service('turn_off', blocking=blocking)
 
-    async def toggle(self):
+    async def toggle(self, blocking=True):
         logger.info(f'Toggling {self.full_identity}|{self.alias}')
-        await self.client.call_service(
-            domain=self.DOMAIN,
-            service='toggle',
-            data={"service_data": {"entity_id": self.full_identity}})
+        return await self.call_service('toggle', blocking=blocking)
 
     async def subscribe(self):
         """ Subscribe to state changes
@@ -203,8 +365,8 @@ class BoolenStateEntity(Component):
 
     @property
     def state(self):
-        raw = self.state_manager.get(self.full_identity)
-        return bool(raw.lower() == 'on')
+        record = self.state_manager.get_state(self.full_identity)
+        return record is not None and record.value is True
 
 
 class Light(BoolenStateEntity):
@@ -222,54 +384,53 @@ class Light(BoolenStateEntity):
         super().__init__(*args, **kwargs)
         self.turn_off_timer = Timer(callback=self.turn_off, timeout=0)
 
-    async def set_state(self, on=True, brightness=None, duration=None, color=None):
+    def target_attributes(self, service_data):
+        attributes = {}
+        if 'brightness_pct' in service_data:
+            attributes['brightness'] = round(service_data['brightness_pct'] * 255 / 100)
+        if 'rgb_color' in service_data:
+            attributes['rgb_color'] = list(service_data['rgb_color'])
+        return attributes
+
+    async def set_state(self, on=True, brightness=None, duration=None, color=None, blocking=True):
         if on:
-            await self.turn_on(brightness, duration, color)
+            return await self.turn_on(brightness, duration, color, blocking=blocking)
         else:
-            await self.turn_off()
+            return await self.turn_off(blocking=blocking)
 
-    async def turn_on(self, brightness=100, duration=None, color=None):
+    async def turn_on(self, brightness=100, duration=None, color=None, blocking=True):
         logger.info(f'Turning on {self.full_identity}|{self.alias}|b:{brightness}')
-        service_data = {"entity_id": self.full_identity}
-        service_data.update({"transition": 0})
+        service_data = {"transition": 0}
         if brightness:
             service_data.update({"brightness_pct": brightness})
         
         if color:
             service_data.update({"rgb_color": color})
 
-        await self.client.call_service(
-            domain=self.DOMAIN,
-            service='turn_on',
-            data={"service_data": service_data})
+        result = await self.call_service('turn_on', service_data, blocking=blocking)
 
         if duration:
             self.turn_off_timer.timeout = duration
             await self.turn_off_timer.restart()
         else:
             await self.turn_off_timer.cancel()
+        return result
 
-    async def turn_off(self):
+    async def turn_off(self, blocking=True):
         logger.info(f'Turning off {self.full_identity}|{self.alias}')
         await self.turn_off_timer.cancel()
-
-        service_data = {"entity_id": self.full_identity}
-        service_data.update({"transition": 0})
-        await self.client.call_service(
-            domain=self.DOMAIN,
-            service='turn_off',
-            data={"service_data": service_data})
+        return await self.call_service('turn_off', {"transition": 0}, blocking=blocking)
 
 
 class Outlet(BoolenStateEntity):
 
     DOMAIN = hass_ae.domain.SWITCH
 
-    async def set_state(self, on=True):
+    async def set_state(self, on=True, blocking=True):
         if on:
-            await self.turn_on()
+            return await self.turn_on(blocking=blocking)
         else:
-            await self.turn_off()
+            return await self.turn_off(blocking=blocking)
 
 class InputBoolean(BoolenStateEntity):
     DOMAIN = hass_ae.domain.INPUT_BOOLEAN
@@ -281,77 +442,148 @@ class Switch(BoolenStateEntity):
 class Vacuum(Component):
 
     DOMAIN = hass_ae.domain.VACUUM
+    HAS_STATE = True
 
     def __init__(self, state_manager, handler=None,  **kwargs):
         self.handler = handler
         self.state_manager = state_manager
         super().__init__(**kwargs)
 
-    async def start(self):
+    async def start(self, blocking=True):
         logger.info(f'Turning on {self.full_identity}|{self.alias}')
-        await self.client.call_service(
-            domain=self.DOMAIN,
-            service='start',
-            data={"service_data": {"entity_id": self.full_identity}})
+        return await self.call_service('start', blocking=blocking)
 
-    async def stop(self):
+    async def stop(self, blocking=True):
         logger.info(f'Returning {self.full_identity}|{self.alias}')
-        await self.client.call_service(
-            domain=self.DOMAIN,
-            service='return_to_base',
-            data={"service_data": {"entity_id": self.full_identity}})
+        return await self.call_service('return_to_base', blocking=blocking)
 
-    async def park(self):
+    async def park(self, blocking=True):
         logger.info(f'Parking {self.full_identity}|{self.alias}')
-        await self.client.call_service(
-            domain=self.DOMAIN,
-            service='stop',
-            data={"service_data": {"entity_id": self.full_identity}})
+        return await self.call_service('stop', blocking=blocking)
 
     @property
     def state(self):
-        raw = self.state_manager.get(self.full_identity)
-        return bool(raw.lower() != 'docked')
+        record = self.state_manager.get_state(self.full_identity)
+        return record is not None and record.state != 'docked'
 
 class Timer():
+    """Calls callback, a coroutine function, timeout seconds after start
 
-    WEAKUP_INTERVAL = 60
+    Deadlines are kept by the loop's Scheduler, restarting only
+    moves the deadline. The callback runs in its own task, which
+    cancel also cancels.
+    """
 
-    def __init__(self, callback, timeout):
+    def __init__(self, callback, timeout, scheduler=None):
         self.timeout = timeout
         self.callback = callback
         self.task = None
-        self.time_left = timeout
-
-    async def _timer_fn(self):
-
-        def interval_generator():
-            self.time_left = self.timeout
-            while self.time_left > self.WEAKUP_INTERVAL:
-                self.time_left = self.time_left-self.WEAKUP_INTERVAL
-                yield self.WEAKUP_INTERVAL
-            yield self.time_left
+        self.scheduler = scheduler
+        self._entry = None
 
-        for i in interval_generator():
-            logger.debug(f'Timer: {self.time_left} remaining {self.callback}')
-            await asyncio.sleep(i)
+    @property
+    def time_left(self):
+        if self._entry is None:
+            return self.timeout
+        return max(self._entry.deadline - hass_ae.clock.get_clock().time(), 0)
 
+    def _fire(self):
+        self._entry = None
         logger.debug(f'Timer: executing {self.callback}')
-        await self.callback()
+        self.task = asyncio.ensure_future(self.callback())
 
     async def start(self):
         logger.debug(f'Timer: started {self.callback}')
-        self.task = asyncio.create_task(self._timer_fn())
+        scheduler = self.scheduler or hass_ae.scheduler.get_scheduler()
+        self._entry = scheduler.call_later(self.timeout, self._fire)
 
     async def restart(self):
         await self.cancel()
         await self.start()
     
     async def cancel(self):
-        if self.task:
+        if self._entry:
             logger.debug(f'Timer: canceled {self.callback}')
+            self._entry.cancel()
+            self._entry = None
+        # the callback may cancel its own timer, as Light.turn_off does
+        if self.task and self.task is not asyncio.current_task():
             self.task.cancel()
 
+class CommandChannel():
+    """Last-write-wins queue of the commands to one entity
+
+    A command starts right away unless the previous one started
+    less than interval seconds ago. It then waits for its turn,
+    and a newer command replaces it. Replaced commands are never
+    sent, they are counted in dropped and their callers get the
+    result of the command that replaced them.
+
+    Commands submitted without wait return None instead of waiting
+    for their turn. Callers that handle events in order, like
+    switch handlers, must not wait, or the next event that would
+    replace the command is only handled once it was sent.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.dropped = 0
+        self._last = None
+        self._next = None
+        self._task = None
+
+    async def submit(self, command, wait=True):
+        clock = hass_ae.clock.get_clock()
+        if self._task is None and (
+                self._last is None or clock.time() - self._last >= self.interval):
+            self._last = clock.time()
+            return await command()
+
+        future = asyncio.get_event_loop().create_future()
+        if not wait:
+            future.add_done_callback(self._log_failure)
+        if self._next is not None:
+            _, replaced = self._next
+            if not replaced.done():
+                self.dropped += 1
+                future.add_done_callback(lambda f: self._chain(f, replaced))
+        self._next = (command, future)
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if wait:
+            return await asyncio.shield(future)
+
+    async def _run(self):
+        clock = hass_ae.clock.get_clock()
+        try:
+            while self._next is not None:
+                await clock.sleep(self._last + self.interval - clock.time())
+                command, future = self._next
+                self._next = None
+                self._last = clock.time()
+                task = asyncio.ensure_future(command())
+                task.add_done_callback(lambda t, f=future: self._chain(t, f))
+        finally:
+            self._task = None
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f'Queued command failed: {future.exception()!r}')
+
+    @staticmethod
+    def _chain(source, target):
+        if target.done():
+            return
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
+
 class Error(Exception):
     pass
 
@@ -14,7 +14,25 @@ class Config(dict):
             'port':8123,
             'access_token': 'change-me',
             'log_level': 'info',
-            'ws_log_level': 'info'
+            'ws_log_level': 'info',
+            'queue_size': 1000,
+            'queue_overflow': 'drop_oldest',
+            'queue_workers': 8,
+            'state_sync': 'state_changed',
+            'coalesce_messages': 'true',
+            'call_timeout': 30,
+            'batch_calls': 'false',
+            'call_limits': '',
+            # minimum seconds between commands to one entity, per domain
+            'command_intervals': '',
+            'record': '',
+            'json_codec': 'auto',
+            # coalesced frames are arrays and always decoded in full,
+            # so lazy_decode only pays off with coalesce_messages off
+            'lazy_decode': 'false',
+            # auto enables them when state_sync is subscribe_entities
+            'state_triggers': 'auto',
+            'command_connection': 'false'
         }
 
         values = {k:os.getenv(k.upper(), defaults[k]) for k, v in defaults.items()}
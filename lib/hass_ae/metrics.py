@@ -0,0 +1,85 @@
+import time
+import bisect
+import logging
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseTimer:
+    """Records the duration of named phases, in seconds
+
+    Phases are kept in the order they finish.
+    """
+
+    def __init__(self):
+        self.phases = dict()
+        self._start = None
+        self._end = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        if self._start is None:
+            self._start = start
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.phases[name] = end - start
+            self._end = max(end, self._end or end)
+
+    @property
+    def total(self):
+        """Seconds from the start of the first phase to the end of the last"""
+        if self._end is None:
+            return 0
+        return self._end - self._start
+
+    def report(self):
+        phases = ', '.join(f'{k} {v * 1000:.1f} ms' for k, v in self.phases.items())
+        return f'{phases}, total {self.total * 1000:.1f} ms'
+
+
+class Histogram:
+    """Histogram of durations in seconds with fixed buckets
+
+    Percentiles are estimated as the upper bound of the bucket
+    holding them.
+    """
+
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def report(self):
+        return (f'n={self.count} mean={self.mean * 1000:.1f} ms '
+                f'p50<={self.percentile(50) * 1000:.1f} ms '
+                f'p99<={self.percentile(99) * 1000:.1f} ms '
+                f'max={self.max * 1000:.1f} ms')
@@ -0,0 +1,237 @@
+"""Recording and replay of the websocket frame stream
+
+A FrameRecorder attached to hass_ae.client.Websocket appends every
+frame to a capture file, one line per frame:
+
+    <seconds since the epoch> <direction> <frame>
+
+with direction < for received and > for sent frames. Access
+tokens are blanked out. Set RECORD to a path to capture a live
+session.
+
+A Replay feeds the events of a capture through a Client running
+an automation setup against a fake websocket, at the original
+speed, N times faster or as fast as possible, and reports event
+throughput, handler latency and the service calls made:
+
+    python -m benchmarks.replay capture.log --setup automation:setup --speed 10
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import statistics
+import time
+from collections import Counter
+
+import hass_ae.client
+import hass_ae.clock
+import hass_ae.components
+import hass_ae.metrics
+import hass_ae.simulation
+
+logger = logging.getLogger(__name__)
+
+RECEIVED = '<'
+SENT = '>'
+
+
+class FrameRecorder:
+    """Appends frames to a capture file off the event loop
+
+    Lines are buffered and written by a single worker thread, at
+    most FLUSH_INTERVAL seconds after they were recorded or as soon
+    as FLUSH_FRAMES lines are waiting. close writes what is left.
+    """
+
+    FLUSH_INTERVAL = 1
+    FLUSH_FRAMES = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.frames = 0
+        self._file = open(path, 'a')
+        self._buffer = []
+        self._flush_handle = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def received(self, message):
+        self._write(RECEIVED, message)
+
+    def sent(self, data):
+        if data.get('type') == 'auth':
+            data = dict(data, access_token='')
+        self._write(SENT, json.dumps(data))
+
+    def _write(self, direction, message):
+        self.frames += 1
+        self._buffer.append(f'{hass_ae.clock.get_clock().now():.6f} {direction} {message}\n')
+        if len(self._buffer) >= self.FLUSH_FRAMES:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                self.FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._buffer:
+            lines, self._buffer = self._buffer, []
+            # one worker thread keeps the writes in order
+            self._executor.submit(self._write_lines, lines)
+
+    def _write_lines(self, lines):
+        self._file.writelines(lines)
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self._file.close()
+
+
+def read_frames(path):
+    """Yield (timestamp, direction, message) for each recorded
+    message, with array frames unpacked
+    """
+    with open(path) as f:
+        for line in f:
+            timestamp, direction, frame = line.rstrip('\n').split(' ', 2)
+            messages = json.loads(frame)
+            if not isinstance(messages, list):
+                messages = [messages]
+            for message in messages:
+                yield float(timestamp), direction, message
+
+
+class ReplayClient(hass_ae.client.Client):
+    """Client timing the handling of every event"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handled = 0
+        self.handler_latency = []
+
+    async def _handle(self, data):
+        if data.get('type') != 'event':
+            return await super()._handle(data)
+
+        start = time.perf_counter()
+        try:
+            await super()._handle(data)
+        finally:
+            self.handler_latency.append(time.perf_counter() - start)
+            self.handled += 1
+
+
+class Replay:
+    """Replays the events of a capture through an automation setup
+
+    speed is the factor the original timing is sped up by, None
+    replays as fast as possible. The initial states are those of
+    the recorded get_states result. Only events of subscribe_events
+    subscriptions are replayed.
+    """
+
+    def __init__(self, path, setup, speed=None):
+        self.path = path
+        self.setup = setup
+        self.speed = speed
+        self.skipped = 0
+        self.duration = 0
+
+    def _load(self):
+        requests = dict()
+        states = []
+        events = []
+        for timestamp, direction, message in read_frames(self.path):
+            if direction == SENT:
+                if 'id' in message:
+                    requests[message['id']] = message
+                continue
+
+            request = requests.get(message.get('id'), {})
+            if message.get('type') == 'result' and request.get('type') == 'get_states':
+                states = message.get('result') or []
+            elif message.get('type') == 'event':
+                if request.get('type') == 'subscribe_events':
+                    events.append((timestamp, message['event']))
+                else:
+                    self.skipped += 1
+        return states, events
+
+    async def run(self):
+        states, events = self._load()
+        self.ws = hass_ae.simulation.FakeWebsocket(states, reflect_states=False)
+        state_manager = hass_ae.client.StateManager()
+        registry = hass_ae.components.ComponentRegistry()
+        queue = hass_ae.client.EventQueue(
+            maxsize=1000, policy=hass_ae.client.OverflowPolicy.BLOCK)
+        self.client = ReplayClient(self.ws, queue=queue)
+
+        await self.client.connect()
+        listen_task = asyncio.create_task(self.client.listen())
+        await self.client.authenticate('replay')
+        state_manager.load(await self.client.get_states())
+        await self.client.dispatcher.register_all(
+            'state_changed',
+            lambda data, client: state_manager.event_callback(data))
+        await self.setup(
+            client=self.client,
+            state_manager=state_manager,
+            registry=registry,
+            timings=hass_ae.metrics.PhaseTimer())
+
+        # only events with a subscriber reach the client
+        events = [e for e in events if e[1]['event_type'] in self.ws.subscriptions]
+        self.events = len(events)
+
+        start = time.perf_counter()
+        first = events[0][0] if events else 0
+        for timestamp, event in events:
+            if self.speed:
+                delay = (timestamp - first) / self.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.ws.fire_event(event['event_type'], event['data'])
+            await asyncio.sleep(0)
+
+        # a recorded event can reach the client as several frames,
+        # e.g. as state_changed and as a state trigger
+        while self.client.handled < self.ws.events_sent:
+            await asyncio.sleep(0.001)
+        self.duration = time.perf_counter() - start
+
+        listen_task.cancel()
+        try:
+            await listen_task
+        except asyncio.CancelledError:
+            pass
+        return self.report()
+
+    def report(self):
+        latency = sorted(self.client.handler_latency)
+        service_calls = Counter(
+            f'{c.domain}.{c.service}' for c in self.ws.service_calls)
+
+        def percentile(q):
+            if not latency:
+                return 0
+            return latency[min(int(len(latency) * q / 100), len(latency) - 1)] * 1000
+
+        return {
+            'events': self.events,
+            'skipped': self.skipped,
+            'duration_s': self.duration,
+            'events_per_s': self.events / self.duration if self.duration else 0,
+            'latency_ms': {
+                'mean': statistics.mean(latency) * 1000 if latency else 0,
+                'p50': percentile(50),
+                'p95': percentile(95),
+                'p99': percentile(99),
+                'max': latency[-1] * 1000 if latency else 0,
+            },
+            'service_calls': dict(service_calls),
+        }
@@ -0,0 +1,117 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import weakref
+import hass_ae.clock
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Runs callbacks at deadlines from a single task
+
+    Entries are kept in a heap ordered by deadline, and the task
+    sleeps until the earliest one is due, so there are no periodic
+    wakeups. Scheduling is O(log n). Cancelled entries stay in the
+    heap until they reach the top or the heap is compacted, which
+    makes cancelling O(1).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cancelled = 0
+        self._task = None
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_later(self, delay, callback):
+        """Call callback, a plain function, in delay seconds
+
+        Returns the entry, which can be cancelled.
+        """
+        clock = hass_ae.clock.get_clock()
+        entry = ScheduledEntry(self, clock.time() + delay, callback)
+        heapq.heappush(self._heap, (entry.deadline, next(self._counter), entry))
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        elif self._heap[0][2] is entry:
+            self._wake()
+        return entry
+
+    def _cancel(self, entry):
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+            self._heap = [item for item in self._heap if not item[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def _wake(self):
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        clock = hass_ae.clock.get_clock()
+        try:
+            while self._heap:
+                deadline, _, entry = self._heap[0]
+                if entry.cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                    continue
+
+                delay = deadline - clock.time()
+                if delay > 0:
+                    self._wakeup = loop.create_future()
+                    timer = clock.call_later(delay, self._wake)
+                    try:
+                        await self._wakeup
+                    finally:
+                        timer.cancel()
+                    continue
+
+                heapq.heappop(self._heap)
+                entry.fire()
+        finally:
+            self._task = None
+
+
+class ScheduledEntry:
+
+    __slots__ = ('scheduler', 'deadline', 'callback', 'cancelled')
+
+    def __init__(self, scheduler, deadline, callback):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler._cancel(self)
+
+    def fire(self):
+        # a fired entry can't be cancelled anymore
+        self.cancelled = True
+        try:
+            self.callback()
+        except Exception:
+            logger.exception(f'Failure in scheduled callback {self.callback}')
+
+
+_schedulers = weakref.WeakKeyDictionary()
+
+
+def get_scheduler():
+    """The scheduler of the current event loop"""
+    loop = asyncio.get_event_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        scheduler = _schedulers[loop] = Scheduler()
+    return scheduler
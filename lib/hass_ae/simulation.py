@@ -0,0 +1,262 @@
+"""Deterministic simulation of automations
+
+Runs an automation setup function against a fake websocket on a
+virtual clock. Events are scripted, time only moves when advanced
+and every service call the automations make is recorded:
+
+    simulation = Simulation(setup, states=[...])
+    await simulation.start()
+    await simulation.press('sw_tf_1', 1002)
+    await simulation.advance(15 * 60)
+    assert simulation.calls('light', 'turn_off')
+
+Service calls succeed and, unless disabled, turn_on and turn_off
+are reflected back as state_changed events. State triggers fire
+on the state_changed events of their entities.
+"""
+
+import asyncio
+import copy
+import datetime
+import logging
+
+import hass_ae.client
+import hass_ae.clock
+import hass_ae.components
+import hass_ae.metrics
+
+logger = logging.getLogger(__name__)
+
+
+class FakeWebsocket:
+    """Stands in for hass_ae.client.Websocket, answering requests
+    the way Home Assistant would
+    """
+
+    # Services whose effect on the state is reflected back
+    SERVICE_STATES = {'turn_on': 'on', 'turn_off': 'off'}
+
+    def __init__(self, states=None, clock=None, reflect_states=True):
+        self.states = {s['entity_id']: s for s in states or []}
+        self.clock = clock or hass_ae.clock.get_clock()
+        self.reflect_states = reflect_states
+        self.service_calls = []
+        self.subscriptions = dict()
+        self.triggers = dict()
+        self.frames_received = 0
+        self.messages_received = 0
+        self.events_sent = 0
+        self._last_id = 0
+        self._inbound = asyncio.Queue()
+
+    async def connect(self, host=None, port=None):
+        self._last_id = 0
+        await self._put({'type': 'auth_required'})
+
+    async def close(self):
+        await self._inbound.put(None)
+
+    async def receive(self):
+        message = await self._inbound.get()
+        if message is not None:
+            self.frames_received += 1
+            self.messages_received += 1
+        return message
+
+    async def send(self, data):
+        type_ = data['type']
+        if type_ == 'auth':
+            return await self._put({'type': 'auth_ok'})
+
+        if data['id'] <= self._last_id:
+            return await self._put(id_reuse_result(data['id']))
+        self._last_id = data['id']
+
+        if type_ == 'subscribe_events':
+            self.subscriptions.setdefault(data['event_type'], []).append(data['id'])
+        elif type_ == 'subscribe_trigger':
+            entity_ids = data['trigger']['entity_id']
+            if isinstance(entity_ids, str):
+                entity_ids = [entity_ids]
+            self.triggers[data['id']] = set(entity_ids)
+        elif type_ == 'get_states':
+            return await self._result(data['id'], list(copy.deepcopy(self.states).values()))
+        elif type_ == 'call_service':
+            await self._result(data['id'], {'context': {'id': 'simulation'}})
+            return await self._call_service(data)
+
+        await self._result(data['id'])
+
+    async def fire_event(self, event_type, data):
+        for identity in self.subscriptions.get(event_type, []):
+            await self._put({
+                'id': identity,
+                'type': 'event',
+                'event': {'event_type': event_type, 'data': data}
+            })
+
+        if event_type != 'state_changed':
+            return
+        for identity, entity_ids in self.triggers.items():
+            if data['entity_id'] in entity_ids:
+                await self._put({
+                    'id': identity,
+                    'type': 'event',
+                    'event': {'variables': {'trigger': {
+                        'platform': 'state',
+                        'entity_id': data['entity_id'],
+                        'from_state': data['old_state'],
+                        'to_state': data['new_state']
+                    }}}
+                })
+
+    async def set_state(self, entity_id, state, attributes=None):
+        old_state = self.states.get(entity_id)
+        new_state = {
+            'entity_id': entity_id,
+            'state': state,
+            'attributes': attributes or {},
+            'last_changed': self._timestamp(),
+            'last_updated': self._timestamp()
+        }
+        if old_state is not None and old_state.get('state') == state:
+            new_state['last_changed'] = old_state.get('last_changed', new_state['last_changed'])
+        self.states[entity_id] = new_state
+        await self.fire_event('state_changed', {
+            'entity_id': entity_id,
+            'old_state': old_state,
+            'new_state': new_state
+        })
+
+    async def _call_service(self, data):
+        service_data = data.get('service_data', {})
+        self.service_calls.append(ServiceCall(
+            self.clock.time(), data['domain'], data['service'], service_data))
+
+        state = self.SERVICE_STATES.get(data['service'])
+        if not self.reflect_states or state is None:
+            return
+
+        entity_ids = service_data.get('entity_id', [])
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        for entity_id in entity_ids:
+            attributes = {}
+            if state == 'on' and 'brightness_pct' in service_data:
+                attributes['brightness'] = round(service_data['brightness_pct'] * 255 / 100)
+            if state == 'on' and 'rgb_color' in service_data:
+                attributes['rgb_color'] = list(service_data['rgb_color'])
+            await self.set_state(entity_id, state, attributes)
+
+    def _timestamp(self):
+        return datetime.datetime.fromtimestamp(
+            self.clock.now(), datetime.timezone.utc).isoformat()
+
+    async def _result(self, identity, result=None):
+        await self._put({'id': identity, 'type': 'result', 'success': True, 'result': result})
+
+    async def _put(self, message):
+        if message.get('type') == 'event':
+            self.events_sent += 1
+        await self._inbound.put(message)
+
+
+def id_reuse_result(identity):
+    """Home Assistant's answer to an id not above the last one"""
+    return {
+        'id': identity,
+        'type': 'result',
+        'success': False,
+        'error': {'code': 'id_reuse', 'message': 'Identifier values have to increase.'}
+    }
+
+
+class ServiceCall:
+
+    __slots__ = ('time', 'domain', 'service', 'service_data')
+
+    def __init__(self, time, domain, service, service_data):
+        self.time = time
+        self.domain = domain
+        self.service = service
+        self.service_data = service_data
+
+    @property
+    def entity_id(self):
+        return self.service_data.get('entity_id')
+
+    def __repr__(self):
+        return f'ServiceCall {self.time:.1f}s {self.domain}.{self.service} {self.entity_id}'
+
+
+class Simulation:
+    """An automation setup running on a virtual clock
+
+    start() installs the virtual clock and brings the client up
+    like hass_ae.async_main does, stop() restores the previous
+    clock.
+    """
+
+    def __init__(self, setup, states=None, clock=None, reflect_states=True):
+        self.setup = setup
+        self.clock = clock or hass_ae.clock.VirtualClock()
+        self.ws = FakeWebsocket(states, self.clock, reflect_states)
+        self.state_manager = hass_ae.client.StateManager()
+        self.registry = hass_ae.components.ComponentRegistry()
+        self.client = hass_ae.client.Client(self.ws)
+        self.client.queue.on_drop(self.state_manager.frame_dropped)
+        self._previous_clock = None
+        self._listen_task = None
+
+    @property
+    def service_calls(self):
+        return self.ws.service_calls
+
+    def calls(self, domain=None, service=None, entity_id=None):
+        """Recorded service calls, optionally filtered"""
+        return [
+            call for call in self.ws.service_calls
+            if (domain is None or call.domain == domain)
+            and (service is None or call.service == service)
+            and (entity_id is None or call.entity_id == entity_id)]
+
+    async def start(self):
+        self._previous_clock = hass_ae.clock.set_clock(self.clock)
+        await self.client.connect()
+        self._listen_task = asyncio.create_task(self.client.listen())
+        await self.client.authenticate('simulation')
+
+        self.state_manager.load(await self.client.get_states())
+        await self.client.dispatcher.register_all(
+            'state_changed',
+            lambda data, client: self.state_manager.event_callback(data))
+
+        await self.setup(
+            client=self.client,
+            state_manager=self.state_manager,
+            registry=self.registry,
+            timings=hass_ae.metrics.PhaseTimer())
+        await self.clock.settle()
+        return self
+
+    async def stop(self):
+        self._listen_task.cancel()
+        try:
+            await self._listen_task
+        except asyncio.CancelledError:
+            pass
+        hass_ae.clock.set_clock(self._previous_clock)
+
+    async def advance(self, seconds):
+        await self.clock.advance(seconds)
+
+    async def fire_event(self, event_type, data):
+        await self.ws.fire_event(event_type, data)
+        await self.clock.settle()
+
+    async def press(self, switch, event=1002):
+        await self.fire_event('deconz_event', {'id': switch, 'event': event})
+
+    async def set_state(self, entity_id, state, attributes=None):
+        await self.ws.set_state(entity_id, state, attributes)
+        await self.clock.settle()
@@ -0,0 +1,113 @@
+"""Shared helpers for tests running automations and clients on
+hass_ae.simulation
+"""
+
+import asyncio
+
+import hass_ae.client
+import hass_ae.clock
+import hass_ae.components
+from hass_ae.simulation import FakeWebsocket, Simulation
+
+
+def state(entity_id, value='off'):
+    return {
+        'entity_id': entity_id,
+        'state': value,
+        'attributes': {},
+        'last_changed': '2020-08-01T10:00:00+00:00',
+        'last_updated': '2020-08-01T10:00:00+00:00'
+    }
+
+
+class Handler:
+
+    def __init__(self):
+        self.signals = []
+
+    async def on(self):
+        self.signals.append(True)
+
+    async def off(self):
+        self.signals.append(False)
+
+
+def simulate(scenario, setup=None, states=None, **kwargs):
+    """Run scenario(simulation, components) on a started simulation"""
+    components = {}
+
+    async def _setup(client, state_manager, registry, timings):
+        if setup:
+            components.update(setup(client, state_manager))
+        registry.register(list(components.values()))
+        await registry.subscribe_all()
+
+    async def _main():
+        simulation = Simulation(_setup, states=states, **kwargs)
+        await simulation.start()
+        try:
+            return await scenario(simulation, components)
+        finally:
+            await simulation.stop()
+
+    return asyncio.run(_main())
+
+
+def light(client, state_manager, **kwargs):
+    return hass_ae.components.Light(
+        identity='a', alias='a', client=client, state_manager=state_manager, **kwargs)
+
+
+async def start_client(ws=None, **kwargs):
+    """A Client listening and authenticated on ws, by default a
+    FakeWebsocket. Cancel client.listen_task to stop it.
+    """
+    client = hass_ae.client.Client(ws or FakeWebsocket(), **kwargs)
+    await client.connect()
+    client.listen_task = asyncio.ensure_future(client.listen())
+    await client.authenticate('simulation')
+    return client
+
+
+def run_client(scenario, ws=None, **kwargs):
+    async def _main():
+        client = await start_client(ws, **kwargs)
+        try:
+            return await scenario(client, client.ws)
+        finally:
+            client.listen_task.cancel()
+
+    return asyncio.run(_main())
+
+
+class SilentWebsocket(FakeWebsocket):
+    """Never answers calls of the services in silent"""
+
+    def __init__(self, *args, silent=('turn_off',), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.silent = silent
+        self.unanswered = []
+
+    async def send(self, data):
+        if data.get('service') in self.silent:
+            self.unanswered.append(data)
+            return
+        await super().send(data)
+
+
+def turn_on(client, entity_id, **kwargs):
+    return client.call_service(
+        'light', 'turn_on', {'service_data': {'entity_id': entity_id}}, **kwargs)
+
+
+def run_virtual(main):
+    """Run main(clock) with a VirtualClock installed"""
+    async def _main():
+        clock = hass_ae.clock.VirtualClock()
+        previous = hass_ae.clock.set_clock(clock)
+        try:
+            return await main(clock)
+        finally:
+            hass_ae.clock.set_clock(previous)
+
+    return asyncio.run(_main())
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+from hass_ae.components import Light
+from hass_ae.simulation import Simulation
+
+from tests.helpers import run_virtual, state
+
+# the automations sit next to lib, in src/ of the repository and in
+# app/ of the docker image
+for name in ('src', 'app'):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', name))
+automation = pytest.importorskip('automation')
+
+
+def test_quick_presses_send_first_and_last_brightness():
+    async def main(clock):
+        simulation = Simulation(
+            automation.setup, states=[state('light.l_tf_6')], clock=clock)
+        await simulation.start()
+        try:
+            for _ in range(6):
+                await simulation.press('sw_tf_6', 1002)
+                await simulation.advance(0.05)
+            await simulation.advance(2)
+            light = simulation.registry.get(Light, 'linus_roof')
+            calls = simulation.calls('light', 'turn_on', 'light.l_tf_6')
+            return [call.service_data['brightness_pct'] for call in calls], light.commands
+        finally:
+            await simulation.stop()
+
+    sent, commands = run_virtual(main)
+    assert sent == [10, 40]
+    assert commands.dropped == 4
@@ -0,0 +1,307 @@
+import asyncio
+
+import pytest
+
+import hass_ae.client
+import hass_ae.clock
+from hass_ae.simulation import FakeWebsocket, id_reuse_result
+
+from tests.helpers import SilentWebsocket, state, run_client, run_virtual, start_client, turn_on
+
+
+def event(identity, entity_id):
+    return {
+        'id': identity,
+        'type': 'event',
+        'event': {'event_type': 'state_changed', 'data': {'entity_id': entity_id}}
+    }
+
+
+def put(queue, data):
+    queue.put_nowait(
+        hass_ae.client.queue_key(data), data, hass_ae.client.is_entity_diff(data))
+
+
+def test_queue_hands_out_frames_of_a_key_in_order():
+    async def _main():
+        queue = hass_ae.client.EventQueue()
+        first, second, other = event(1, 'light.a'), event(1, 'light.a'), event(1, 'light.b')
+        for data in (first, second, other):
+            put(queue, data)
+
+        key, data = await queue.get()
+        assert data is first
+        # light.a is claimed, its next frame waits for next()
+        assert (await queue.get())[1] is other
+        assert queue.next(key) is second
+        assert queue.next(key) is None
+
+    asyncio.run(_main())
+
+
+def test_queue_drops_oldest_frame_of_the_same_key():
+    async def _main():
+        queue = hass_ae.client.EventQueue(maxsize=2)
+        frames = [event(1, 'light.a'), event(1, 'light.b'), event(1, 'light.a')]
+        for data in frames:
+            put(queue, data)
+
+        assert queue.dropped == 1
+        assert (await queue.get())[1] is frames[1]
+        assert (await queue.get())[1] is frames[2]
+
+    asyncio.run(_main())
+
+
+def test_queue_never_drops_entity_diffs():
+    async def _main():
+        queue = hass_ae.client.EventQueue(maxsize=2)
+        added = {'id': 5, 'type': 'event', 'event': {'a': {'light.a': {}}}}
+        changed = {'id': 5, 'type': 'event', 'event': {'c': {'light.a': {}}}}
+        other = event(3, 'light.b')
+        for data in (added, changed, other):
+            put(queue, data)
+
+        assert queue.dropped == 0
+        assert queue.depth == 3
+        key, data = await queue.get()
+        assert data is added
+        assert queue.next(key) is changed
+
+    asyncio.run(_main())
+
+
+def test_block_policy_handles_events_while_lane_is_full():
+    handled = []
+
+    async def scenario(client, ws):
+        async def _handler(data, client):
+            await turn_on(client, 'light.a')
+            handled.append(data['event']['data']['id'])
+
+        await client.dispatcher.register_all('deconz_event', _handler)
+        for i in range(4):
+            await ws.fire_event('deconz_event', {'id': f'sw_{i}', 'event': 1002})
+        for _ in range(100):
+            if len(handled) == 4:
+                break
+            await asyncio.sleep(0.01)
+
+    queue = hass_ae.client.EventQueue(maxsize=2, policy='block')
+    run_client(scenario, queue=queue, workers=1, call_timeout=0)
+    assert queue.dropped == 0
+    assert sorted(handled) == [f'sw_{i}' for i in range(4)]
+
+
+def test_block_policy_backlog_is_bounded():
+    async def scenario(client, ws):
+        async def _handler(data, client):
+            await asyncio.sleep(0.01)
+
+        await client.dispatcher.register_all('deconz_event', _handler)
+        for i in range(500):
+            await ws.fire_event('deconz_event', {'id': f'sw_{i % 3}', 'event': 1002})
+        for _ in range(100):
+            await asyncio.sleep(0)
+        return client.max_backlog, client.queue.dropped
+
+    queue = hass_ae.client.EventQueue(maxsize=10, policy='block')
+    max_backlog, dropped = run_client(scenario, queue=queue, workers=1)
+    assert max_backlog == 10
+    assert dropped >= 480
+
+
+def test_synced_at_follows_the_live_subscription():
+    async def _main():
+        clock = hass_ae.clock.VirtualClock()
+        previous = hass_ae.clock.set_clock(clock)
+        try:
+            state_manager = hass_ae.client.StateManager()
+            assert state_manager.synced_at is None
+
+            state_manager.load([])
+            await clock.advance(60)
+            assert state_manager.synced_at == clock.time()
+
+            state_manager.mark_unsynced()
+            lost_at = clock.time()
+            await clock.advance(60)
+            assert state_manager.synced_at == lost_at
+        finally:
+            hass_ae.clock.set_clock(previous)
+
+    asyncio.run(_main())
+
+
+def test_notifications_are_coalesced_per_domain():
+    async def main(clock):
+        state_manager = hass_ae.client.StateManager(coalesce_windows={'sensor': 1})
+        notified = []
+
+        async def _callback(value):
+            notified.append((clock.time(), value))
+
+        await state_manager.subscribe('sensor.power', _callback)
+        await state_manager.subscribe('light.a', _callback)
+        for value in ('1', '2', '3'):
+            await state_manager.update('sensor.power', value)
+            await state_manager.update('light.a', value)
+            await clock.advance(0.1)
+        await clock.advance(1)
+        return notified, state_manager.collapsed['sensor.power']
+
+    notified, collapsed = run_virtual(main)
+    assert [value for _, value in notified] == ['1', '2', '3', '3']
+    assert notified[-1][0] == 1
+    assert collapsed == 2
+
+
+def turn_off(client, entity_id, **kwargs):
+    return client.call_service(
+        'light', 'turn_off', {'service_data': {'entity_id': entity_id}}, **kwargs)
+
+
+def test_call_times_out():
+    async def main(clock):
+        client = await start_client(SilentWebsocket(clock=clock), call_timeout=5)
+        pending = asyncio.ensure_future(turn_off(client, 'light.a'))
+        overridden = asyncio.ensure_future(turn_off(client, 'light.b', timeout=1))
+        await clock.advance(1)
+        assert overridden.done() and not pending.done()
+        await clock.advance(4)
+        client.listen_task.cancel()
+        return pending, overridden, client
+
+    pending, overridden, client = run_virtual(main)
+    for task in (pending, overridden):
+        with pytest.raises(hass_ae.client.CallTimeoutError):
+            task.result()
+    assert client.calls.expired == 2
+    assert len(client.calls) == 0
+
+
+def test_cancelled_call_leaves_the_pending_table():
+    async def main(clock):
+        client = await start_client(SilentWebsocket(clock=clock))
+        pending = asyncio.ensure_future(turn_off(client, 'light.a'))
+        await clock.settle()
+        assert len(client.calls) == 1
+        pending.cancel()
+        await clock.settle()
+        client.listen_task.cancel()
+        return pending, client
+
+    pending, client = run_virtual(main)
+    assert pending.cancelled()
+    assert len(client.calls) == 0
+
+
+def test_batched_calls_keep_ids_increasing():
+    async def scenario(client, ws):
+        return await asyncio.gather(
+            turn_on(client, 'light.a'),
+            client.call_service('switch', 'turn_on', {'service_data': {'entity_id': 'switch.b'}}),
+            turn_on(client, 'light.c'),
+            client.get_states())
+
+    ws = FakeWebsocket()
+    results = run_client(scenario, ws, batch_calls=True)
+    assert results[:3] == [{'context': {'id': 'simulation'}}] * 3
+    assert results[3] == []
+    assert [call.entity_id for call in ws.service_calls] == [
+        ['light.a', 'light.c'], 'switch.b']
+
+
+def test_fake_websocket_rejects_reused_ids():
+    async def scenario(client, ws):
+        await client.get_states()
+        call = hass_ae.client.Call(
+            identity=1, request={'id': 1, 'type': 'get_states'})
+        await client.execute_call(call)
+        return await client.wait_for_call(call)
+
+    call = run_client(scenario)
+    assert call.error_code == 'id_reuse'
+
+
+def test_limiter_caps_calls_in_flight_per_network():
+    async def scenario(client, ws):
+        for entity_id in ('light.a', 'light.b', 'light.c'):
+            asyncio.ensure_future(turn_off(client, entity_id, network='rf'))
+        asyncio.ensure_future(turn_off(client, 'light.d', network='zigbee'))
+        for _ in range(10):
+            await asyncio.sleep(0)
+        return sorted(data['service_data']['entity_id'] for data in ws.unanswered)
+
+    in_flight = run_client(scenario, SilentWebsocket(), call_limits={'rf': 2}, call_timeout=0)
+    assert in_flight == ['light.a', 'light.b', 'light.d']
+
+
+def test_cancelled_call_releases_limiter_slot():
+    async def scenario(client, ws):
+        pending = asyncio.ensure_future(client.call_service(
+            'light', 'turn_off', {'service_data': {'entity_id': 'light.a'}}, network='rf'))
+        await asyncio.sleep(0.01)
+        pending.cancel()
+        await asyncio.sleep(0.01)
+        return await asyncio.wait_for(turn_on(client, 'light.a', network='rf'), 1)
+
+    result = run_client(
+        scenario, SilentWebsocket(), call_limits={'rf': 1}, call_timeout=0)
+    assert result == {'context': {'id': 'simulation'}}
+
+
+class NoTriggerWebsocket(FakeWebsocket):
+    """Rejects subscribe_trigger, as Home Assistant versions
+    without it do
+    """
+
+    async def send(self, data):
+        if data.get('type') != 'subscribe_trigger':
+            return await super().send(data)
+        await self._put(dict(id_reuse_result(data['id']), error={
+            'code': 'unknown_command', 'message': 'Unknown command.'}))
+
+
+def test_state_triggers_filter_state_changes():
+    async def scenario(client, ws):
+        changes = []
+
+        async def _handler(data, client):
+            changes.append(data['event']['data']['new_state']['state'])
+
+        await client.dispatcher.register_state('light.a', _handler)
+        await ws.set_state('light.a', 'on')
+        await ws.set_state('light.b', 'on')
+        for _ in range(10):
+            await asyncio.sleep(0)
+        return changes, ws
+
+    changes, ws = run_client(scenario, FakeWebsocket([state('light.a')]), state_triggers=True)
+    assert changes == ['on']
+    assert list(ws.triggers.values()) == [{'light.a'}]
+    assert 'state_changed' not in ws.subscriptions
+
+    changes, ws = run_client(scenario, NoTriggerWebsocket([state('light.a')]), state_triggers=True)
+    assert changes == ['on']
+    assert 'state_changed' in ws.subscriptions
+
+
+def test_service_calls_use_the_command_connection():
+    command_ws = FakeWebsocket()
+
+    async def scenario(client, ws):
+        await turn_on(client, 'light.a')
+        await client.get_states()
+        await command_ws.close()
+        await asyncio.sleep(0)
+        await turn_on(client, 'light.b')
+        return client
+
+    main_ws = FakeWebsocket()
+    client = run_client(scenario, main_ws, command_websocket=command_ws)
+    assert [call.entity_id for call in command_ws.service_calls] == ['light.a']
+    # once the command connection is gone calls use the main connection
+    assert [call.entity_id for call in main_ws.service_calls] == ['light.b']
+    assert set(client.connection_latency) == {
+        hass_ae.client.MAIN_CONNECTION, hass_ae.client.COMMAND_CONNECTION}
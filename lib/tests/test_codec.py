@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+import hass_ae.codec
+from hass_ae.codec import LazyMessage
+from hass_ae.simulation import FakeWebsocket
+
+from tests.helpers import run_client, state
+
+
+class LazyWebsocket(FakeWebsocket):
+    """Hands out event frames undecoded, as Websocket does with
+    lazy set
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.codec = hass_ae.codec.JsonCodec()
+        self.lazy_messages = []
+
+    async def _put(self, message):
+        if message.get('type') == 'event':
+            lazy = LazyMessage.parse(json.dumps(message), self.codec)
+            if lazy is not None:
+                self.lazy_messages.append(lazy)
+                message = lazy
+        await super()._put(message)
+
+
+def frame(entity_id):
+    return json.dumps({
+        'id': 3,
+        'type': 'event',
+        'event': {'event_type': 'state_changed', 'data': {'entity_id': entity_id}}
+    })
+
+
+def test_header_is_read_without_decoding():
+    message = LazyMessage.parse(frame('light.a'), hass_ae.codec.JsonCodec())
+    assert (message.id, message['type'], message.event_type, message.key) == (
+        3, 'event', 'state_changed', 'light.a')
+    assert message
+    assert not message.is_decoded
+    assert message['event']['data'] == {'entity_id': 'light.a'}
+    assert message.is_decoded
+
+
+def test_frames_not_starting_with_the_header_are_not_lazy():
+    codec = hass_ae.codec.JsonCodec()
+    assert LazyMessage.parse('[' + frame('light.a') + ']', codec) is None
+    assert LazyMessage.parse(json.dumps({'id': 3, 'type': 'result'}), codec) is None
+
+
+def test_unrouted_events_stay_undecoded_through_listen():
+    handled = []
+
+    async def scenario(client, ws):
+        async def _handler(data, client):
+            handled.append(data['event']['data']['new_state']['state'])
+
+        await client.dispatcher.register('state_changed', 'light.a', _handler)
+        await ws.set_state('light.a', 'on')
+        for _ in range(3):
+            await ws.set_state('light.b', 'on')
+        for _ in range(10):
+            await asyncio.sleep(0)
+        return ws.lazy_messages
+
+    messages = run_client(scenario, LazyWebsocket([state('light.a'), state('light.b')]))
+    assert handled == ['on']
+    assert [m.is_decoded for m in messages] == [True, False, False, False]
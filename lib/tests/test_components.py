@@ -0,0 +1,125 @@
+import asyncio
+
+import hass_ae.components
+
+from tests.helpers import Handler, light, simulate, state
+
+
+def suppressing_light(client, state_manager, **kwargs):
+    return {'light': light(client, state_manager, suppress_redundant=True, **kwargs)}
+
+
+def test_repeated_command_is_suppressed():
+    async def scenario(simulation, components):
+        await components['light'].turn_off()
+        await components['light'].turn_off()
+        return components['light']
+
+    entity = simulate(scenario, suppressing_light, states=[state('light.a')])
+    assert (entity.sent, entity.suppressed) == (1, 1)
+
+
+def test_command_is_resent_after_refresh_interval():
+    async def scenario(simulation, components):
+        await components['light'].turn_off()
+        await simulation.advance(hass_ae.components.Light.REFRESH_INTERVAL)
+        await components['light'].turn_off()
+        return components['light']
+
+    entity = simulate(scenario, suppressing_light, states=[state('light.a')])
+    assert (entity.sent, entity.suppressed) == (2, 0)
+
+
+def test_dropped_state_change_stops_suppression():
+    async def scenario(simulation, components):
+        simulation.client.queue.count_drop(('state_changed', 'light.b'))
+        await simulation.advance(hass_ae.components.Light.REFRESH_INTERVAL)
+        await components['light'].turn_off()
+        await components['light'].turn_off()
+        return components['light']
+
+    entity = simulate(scenario, suppressing_light, states=[state('light.a')])
+    assert (entity.sent, entity.suppressed) == (2, 0)
+
+
+def test_assumed_state_does_not_suppress():
+    async def scenario(simulation, components):
+        await components['light'].turn_on()
+        pending = simulation.state_manager.is_pending('light.a')
+        await components['light'].turn_on()
+        return pending, components['light']
+
+    pending, entity = simulate(
+        scenario,
+        lambda c, s: suppressing_light(c, s, optimistic=True),
+        states=[state('light.a')], reflect_states=False)
+    assert pending
+    assert (entity.sent, entity.suppressed) == (2, 0)
+
+
+def optimistic_light(client, state_manager):
+    return {'light': light(client, state_manager, optimistic=True)}
+
+
+def test_assumed_state_rolls_back_without_confirmation():
+    async def scenario(simulation, components):
+        await components['light'].turn_on()
+        assumed = simulation.state_manager.get('light.a')
+        await simulation.advance(hass_ae.components.Light.ASSUME_TIMEOUT)
+        return assumed, simulation.state_manager
+
+    assumed, state_manager = simulate(
+        scenario, optimistic_light, states=[state('light.a')], reflect_states=False)
+    assert assumed == 'on'
+    assert state_manager.get('light.a') == 'off'
+    assert state_manager.rolled_back == 1
+
+
+def test_confirmed_state_is_kept():
+    async def scenario(simulation, components):
+        await components['light'].turn_on()
+        await simulation.advance(hass_ae.components.Light.ASSUME_TIMEOUT)
+        return simulation.state_manager
+
+    state_manager = simulate(scenario, optimistic_light, states=[state('light.a')])
+    assert state_manager.get('light.a') == 'on'
+    assert not state_manager.is_pending('light.a')
+    assert state_manager.rolled_back == 0
+
+
+def test_command_interval_sends_last_command():
+    async def scenario(simulation, components):
+        colors = [[i, 0, 0] for i in range(5)]
+        tasks = []
+        for color in colors:
+            tasks.append(asyncio.ensure_future(components['light'].turn_on(color=color)))
+            await simulation.advance(0.1)
+        await simulation.advance(2)
+        await asyncio.gather(*tasks)
+        return [call.service_data['rgb_color'] for call in simulation.calls('light')]
+
+    sent = simulate(
+        scenario,
+        lambda c, s: {'light': light(c, s, command_interval=1)},
+        states=[state('light.a')])
+    assert sent == [[0, 0, 0], [4, 0, 0]]
+
+
+def motion_sensor(handler):
+    def setup(client, state_manager):
+        client.dispatcher.triggers = True
+        return {'motion': hass_ae.components.TFMotionSensor(
+            identity='m', alias='m', client=client, handler=handler)}
+    return setup
+
+
+def test_motion_sensor_state_trigger_is_not_duplicated():
+    handler = Handler()
+
+    async def scenario(simulation, components):
+        await simulation.set_state('binary_sensor.m', 'on')
+        return simulation.ws.triggers
+
+    triggers = simulate(scenario, motion_sensor(handler), states=[state('binary_sensor.m')])
+    assert list(triggers.values()) == [{'binary_sensor.m'}]
+    assert handler.signals == [True]
@@ -0,0 +1,99 @@
+import asyncio
+
+import hass_ae.client
+from benchmarks.fake_hass import FakeHomeAssistant, make_state
+
+
+def run_server(scenario, states, sync=hass_ae.client.SyncMode.SUBSCRIBE_ENTITIES):
+    """Run scenario(server, client, state_manager) against a
+    FakeHomeAssistant, with states synced like hass_ae.async_main does
+    """
+    async def _main():
+        server = await FakeHomeAssistant(states=states).start()
+        client = hass_ae.client.Client(hass_ae.client.Websocket(), reconnect=True)
+        state_manager = hass_ae.client.StateManager()
+        await client.connect('localhost', server.port)
+        listen_task = asyncio.ensure_future(client.listen())
+        try:
+            await client.authenticate(server.access_token)
+            if sync == hass_ae.client.SyncMode.SUBSCRIBE_ENTITIES:
+                await state_manager.sync_entities(client, [s['entity_id'] for s in states])
+            else:
+                state_manager.load(await client.get_states())
+                await client.dispatcher.register_all(
+                    'state_changed', lambda data, client: state_manager.event_callback(data))
+
+                async def _resync(client):
+                    await state_manager.resync(await client.get_states())
+                client.on_reconnect(_resync)
+            return await scenario(server, client, state_manager)
+        finally:
+            listen_task.cancel()
+            await server.stop()
+
+    return asyncio.run(_main())
+
+
+async def wait_for(condition, timeout=2):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('condition not met in time')
+
+
+def test_entity_diffs_update_states():
+    async def scenario(server, client, state_manager):
+        await server.set_state('light.a', 'off')
+        await wait_for(lambda: state_manager.get('light.a') == 'off')
+        return state_manager.get_state('light.a')
+
+    record = run_server(scenario, [make_state('light.a', 'on')])
+    assert record.last_changed > 1596276000
+
+
+def test_change_while_disconnected_is_applied_on_reconnect():
+    async def scenario(server, client, state_manager):
+        await server.set_state('light.a', 'off')
+        await wait_for(lambda: state_manager.get('light.a') == 'off')
+        changes = []
+
+        async def _callback(value):
+            changes.append(value)
+
+        await state_manager.subscribe('light.a', _callback)
+        await server.drop_connections()
+        await server.set_state('light.a', 'on')
+        await wait_for(lambda: state_manager.get('light.a') == 'on')
+        return changes
+
+    assert run_server(scenario, [make_state('light.a', 'on')]) == ['on']
+
+
+def test_reconnect_resyncs_and_replays_subscriptions():
+    async def scenario(server, client, state_manager):
+        await server.drop_connections()
+        await server.set_state('light.a', 'off')
+        await wait_for(lambda: state_manager.get('light.a') == 'off')
+        # events reach the replayed state_changed subscription
+        await server.set_state('light.b', 'on')
+        await wait_for(lambda: state_manager.get('light.b') == 'on')
+        return len(server.connections)
+
+    connections = run_server(
+        scenario, [make_state('light.a', 'on'), make_state('light.b', 'off')],
+        sync=hass_ae.client.SyncMode.STATE_CHANGED)
+    assert connections == 1
+
+
+def test_calls_made_while_reconnecting_wait_for_authentication():
+    async def scenario(server, client, state_manager):
+        await server.drop_connections()
+        result = await client.call_service(
+            'light', 'turn_on', {'service_data': {'entity_id': 'light.a'}})
+        return result, len(server.connections)
+
+    result, connections = run_server(
+        scenario, [make_state('light.a')], sync=hass_ae.client.SyncMode.STATE_CHANGED)
+    assert result is not None
+    assert connections == 1
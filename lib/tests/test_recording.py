@@ -0,0 +1,57 @@
+import asyncio
+import json
+
+import hass_ae.components
+from hass_ae.recording import Replay
+
+from tests.helpers import Handler, state
+
+
+def write_capture(path, changes):
+    """Capture of a get_states snapshot and a state_changed
+    subscription delivering changes of binary_sensor.m
+    """
+    lines = [
+        (1000, '>', {'id': 1, 'type': 'get_states'}),
+        (1000, '<', {'id': 1, 'type': 'result', 'success': True,
+                     'result': [state('binary_sensor.m')]}),
+        (1000, '>', {'id': 2, 'type': 'subscribe_events', 'event_type': 'state_changed'}),
+    ]
+    for i, value in enumerate(changes):
+        lines.append((1000 + i, '<', {'id': 2, 'type': 'event', 'event': {
+            'event_type': 'state_changed',
+            'data': {
+                'entity_id': 'binary_sensor.m',
+                'old_state': None,
+                'new_state': state('binary_sensor.m', value)
+            }
+        }}))
+    path.write_text(''.join(
+        f'{timestamp} {direction} {json.dumps(message)}\n'
+        for timestamp, direction, message in lines))
+
+
+def test_replay_waits_for_trigger_frames(tmp_path):
+    capture = tmp_path / 'capture.log'
+    write_capture(capture, ['on', 'off'] * 5)
+
+    class SlowHandler(Handler):
+        async def on(self):
+            await asyncio.sleep(0.001)
+            await super().on()
+
+    handler = SlowHandler()
+
+    async def setup(client, state_manager, registry, timings):
+        client.dispatcher.triggers = True
+        registry.register([hass_ae.components.TFMotionSensor(
+            identity='m', alias='m', client=client, handler=handler)])
+        await registry.subscribe_all()
+
+    replay = Replay(str(capture), setup)
+    report = asyncio.run(replay.run())
+    assert report['events'] == 10
+    # each change arrives as a state_changed event and a trigger event
+    assert replay.ws.events_sent == 20
+    assert replay.client.handled == 20
+    assert handler.signals == [True, False] * 5
@@ -0,0 +1,57 @@
+import hass_ae.scheduler
+from hass_ae.components import Timer
+
+from tests.helpers import run_virtual
+
+
+def test_callbacks_run_in_deadline_order():
+    async def main(clock):
+        scheduler = hass_ae.scheduler.Scheduler()
+        fired = []
+        for delay in (3, 1, 2):
+            scheduler.call_later(delay, lambda delay=delay: fired.append((delay, clock.time())))
+        cancelled = scheduler.call_later(1.5, lambda: fired.append('cancelled'))
+        cancelled.cancel()
+        await clock.advance(5)
+        return fired, len(scheduler)
+
+    fired, pending = run_virtual(main)
+    assert fired == [(1, 1), (2, 2), (3, 3)]
+    assert pending == 0
+
+
+def test_earlier_deadline_wakes_the_scheduler():
+    async def main(clock):
+        scheduler = hass_ae.scheduler.Scheduler()
+        fired = []
+        scheduler.call_later(60, lambda: fired.append(60))
+        await clock.advance(1)
+        scheduler.call_later(1, lambda: fired.append(2))
+        await clock.advance(1)
+        return fired
+
+    assert run_virtual(main) == [2]
+
+
+def test_timer_restart_moves_the_deadline():
+    async def main(clock):
+        fired = []
+
+        async def _callback():
+            fired.append(clock.time())
+
+        timer = Timer(_callback, 10, scheduler=hass_ae.scheduler.Scheduler())
+        await timer.start()
+        await clock.advance(5)
+        await timer.restart()
+        await clock.advance(9)
+        time_left = timer.time_left
+        await clock.advance(1)
+        await timer.restart()
+        await timer.cancel()
+        await clock.advance(20)
+        return fired, time_left
+
+    fired, time_left = run_virtual(main)
+    assert fired == [15]
+    assert time_left == 1
@@ -0,0 +1,59 @@
+import hass_ae.components
+
+from tests.helpers import Handler, light, simulate, state
+
+
+def test_seeded_state_without_last_changed():
+    seeded = state('light.a', 'on')
+    del seeded['last_changed']
+
+    async def scenario(simulation, components):
+        await simulation.set_state('light.a', 'on')
+        return simulation.ws.states['light.a']
+
+    record = simulate(scenario, states=[seeded])
+    assert record['state'] == 'on'
+    assert record['last_changed']
+
+
+def test_motion_sensor_triggers_handler():
+    handler = Handler()
+
+    def setup(client, state_manager):
+        return {'motion': hass_ae.components.TFMotionSensor(
+            identity='m', alias='m', client=client, handler=handler)}
+
+    async def scenario(simulation, components):
+        await simulation.set_state('binary_sensor.m', 'on')
+        await simulation.set_state('binary_sensor.m', 'off')
+
+    simulate(scenario, setup, states=[state('binary_sensor.m')])
+    assert handler.signals == [True, False]
+
+
+def test_light_commands_are_reflected():
+    async def scenario(simulation, components):
+        await components['light'].turn_on(brightness=50)
+        await simulation.advance(1)
+        await components['light'].turn_off()
+        return simulation.state_manager.get('light.a'), simulation.calls('light')
+
+    result, calls = simulate(
+        scenario, lambda c, s: {'light': light(c, s)}, states=[state('light.a')])
+    assert result == 'off'
+    assert [call.service for call in calls] == ['turn_on', 'turn_off']
+    assert calls[0].service_data['brightness_pct'] == 50
+
+
+def test_timers_run_on_virtual_time():
+    async def scenario(simulation, components):
+        await components['light'].turn_on(duration=15 * 60)
+        await simulation.advance(15 * 60 - 1)
+        before = simulation.state_manager.get('light.a')
+        await simulation.advance(1)
+        return before, simulation.calls('light', 'turn_off')
+
+    before, turned_off = simulate(
+        scenario, lambda c, s: {'light': light(c, s)}, states=[state('light.a')])
+    assert before == 'on'
+    assert [call.time for call in turned_off] == [15 * 60]
@@ -5,6 +5,8 @@ from hass_ae.components import Vacuum
 from hass_ae.handlers import TFMotionSensorHandler, TFSwitchHandler
 from hass_ae.handlers import BooleanStateChangedHandler
 from hass_ae.components import Timer
+from hass_ae.client import join
+import hass_ae.clock
 import hass_ae.domain
 
 import enum
@@ -134,43 +136,54 @@ async def setup(client, state_manager, registry, **kwargs):
             identity='l_tf_1',
             alias='livingroom_side',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='zigbee'
         ),
         Light(
             identity='l_tf_2',
             alias='livingroom_roof',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='zigbee'
         ),
         Light(
             identity='l_tf_3',
             alias='entry_roof_1',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='zigbee'
         ),
         Light(
             identity='l_tf_4',
             alias='secondaryentry_roof',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='zigbee'
         ),
         Light(
             identity='l_tf_5',
             alias='entry_roof_2',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='zigbee'
         ),
         Light(
             identity='l_tf_6',
             alias='linus_roof',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='zigbee',
+            # the switch steps brightness faster than the mesh delivers it
+            command_interval=0.5
         ),
         Light(
             identity='l_tf_7',
             alias='livingroom_roof_2',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='zigbee',
+            # disco picks a color every second, half of them go out
+            command_interval=2
         ),
 
 
@@ -180,37 +193,43 @@ async def setup(client, state_manager, registry, **kwargs):
             identity='o_rf_1',
             alias='tablelamp',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='rf'
         ),
         Outlet(
             identity='o_rf_2',
             alias='whisky',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='rf'
         ),
         Outlet(
             identity='o_rf_3',
             alias='tv',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='rf'
         ),
         Outlet(
             identity='o_rf_4',
             alias='entrylight',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='rf'
         ),
         Outlet(
             identity='o_rf_5',
             alias='na_1',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='rf'
         ),
         Outlet(
             identity='o_tf_1',
             alias='upstairs_nightlight',
             client=client,
-            state_manager=state_manager
+            state_manager=state_manager,
+            network='zigbee'
         ),
     ])
 
@@ -229,11 +248,13 @@ class HomeInputHandler(BooleanStateChangedHandler):
         # await set_tvroom_lights(self.registry, True)
 
     async def off(self):
-        await self.registry.get(Light, 'secondaryentry_roof').turn_off()
-        await set_entry_lights(self.registry, False)
-        await set_livingroom_lights(self.registry, False)
-        await set_tvroom_lights(self.registry, False)
-        await self.registry.get(Outlet, 'tv').turn_off()
+        await join([
+            await self.registry.get(Light, 'secondaryentry_roof').turn_off(blocking=False),
+            *await set_entry_lights(self.registry, False, blocking=False),
+            *await set_livingroom_lights(self.registry, False, blocking=False),
+            *await set_tvroom_lights(self.registry, False, blocking=False),
+            await self.registry.get(Outlet, 'tv').turn_off(blocking=False)
+        ])
 
 class SleepInputHandler(BooleanStateChangedHandler):
 
@@ -270,8 +291,9 @@ class DiscoInputHandler(BooleanStateChangedHandler):
         light = self.registry.get(Light, 'livingroom_roof_2')
         while True:
             color = [random.randint(0,255), random.randint(0,255), random.randint(0,255)]
-            await light.turn_on(brightness=100, color=color)
-            await asyncio.sleep(1)
+            # queued colors are replaced by the next one, see CommandChannel
+            await light.turn_on(brightness=100, color=color, blocking=False)
+            await hass_ae.clock.sleep(1)
 
 class LinusRoomSwitchHandler(TFSwitchHandler):
 
@@ -289,19 +311,22 @@ class LinusRoomSwitchHandler(TFSwitchHandler):
     def reset_states(self):
         self.states = self.state_generator()
 
+    # commands don't wait for the light's command interval, so a
+    # quick press replaces the brightness still waiting to go out
     async def on(self):
-        await self.registry.get(Light, 'linus_roof').turn_on(brightness=next(self.states))
+        await self.registry.get(Light, 'linus_roof').turn_on(
+            brightness=next(self.states), blocking=False)
 
     async def on_long(self):
-        await self.registry.get(Light, 'linus_roof').turn_on(brightness=100)
+        await self.registry.get(Light, 'linus_roof').turn_on(brightness=100, blocking=False)
         self.reset_states()
 
     async def off(self):
-        await self.registry.get(Light, 'linus_roof').turn_off()
+        await self.registry.get(Light, 'linus_roof').turn_off(blocking=False)
         self.reset_states()
 
     async def off_long(self):
-        await self.registry.get(Light, 'linus_roof').turn_off()
+        await self.registry.get(Light, 'linus_roof').turn_off(blocking=False)
         self.reset_states()
 
 
@@ -348,11 +373,13 @@ class NightSwitchHandler(TFSwitchHandler):
         await self.registry.get(Outlet, 'upstairs_nightlight').turn_off()
 
     async def off(self):
-        await set_entry_lights(self.registry, False)
-        await set_livingroom_lights(self.registry, False)
-        await set_tvroom_lights(self.registry, False)
-        await self.registry.get(Outlet, 'tv').turn_off()
-        await self.registry.get(Outlet, 'upstairs_nightlight').turn_on()
+        await join([
+            *await set_entry_lights(self.registry, False, blocking=False),
+            *await set_livingroom_lights(self.registry, False, blocking=False),
+            *await set_tvroom_lights(self.registry, False, blocking=False),
+            await self.registry.get(Outlet, 'tv').turn_off(blocking=False),
+            await self.registry.get(Outlet, 'upstairs_nightlight').turn_on(blocking=False)
+        ])
 
     async def off_long(self):
         await self.registry.get(InputBoolean, 'is_home').turn_off()
@@ -475,25 +502,25 @@ class GardenSwitchHandler(TFSwitchHandler):
         await self.registry.get(Vacuum, 'kitt').stop()
 
 
-async def set_livingroom_lights(registry, on=True, brightess=None):
-    asyncio.gather(
-        registry.get(Light, 'livingroom_roof').set_state(on, brightness=brightess),
-        registry.get(Light, 'livingroom_roof_2').set_state(on, brightness=brightess, color=Light.Color.WARM_WHITE),
-        registry.get(Light, 'livingroom_side').set_state(on, brightness=brightess),
-        registry.get(Outlet, 'tablelamp').set_state(on)
+async def set_livingroom_lights(registry, on=True, brightess=None, blocking=True):
+    return await asyncio.gather(
+        registry.get(Light, 'livingroom_roof').set_state(on, brightness=brightess, blocking=blocking),
+        registry.get(Light, 'livingroom_roof_2').set_state(on, brightness=brightess, color=Light.Color.WARM_WHITE, blocking=blocking),
+        registry.get(Light, 'livingroom_side').set_state(on, brightness=brightess, blocking=blocking),
+        registry.get(Outlet, 'tablelamp').set_state(on, blocking=blocking)
     )
 
 
-async def set_tvroom_lights(registry, on=True, brightess=None):
-    await registry.get(Outlet, 'whisky').set_state(on)
+async def set_tvroom_lights(registry, on=True, brightess=None, blocking=True):
+    return [await registry.get(Outlet, 'whisky').set_state(on, blocking=blocking)]
 
 
-async def set_entry_lights(registry, on=True, brightess=None):
-    asyncio.gather(
-        registry.get(Light, 'entry_roof_1').set_state(on, brightness=brightess),
-        registry.get(Light, 'entry_roof_2').set_state(on, brightness=brightess),
-        registry.get(Outlet, 'entrylight').set_state(on)
+async def set_entry_lights(registry, on=True, brightess=None, blocking=True):
+    return await asyncio.gather(
+        registry.get(Light, 'entry_roof_1').set_state(on, brightness=brightess, blocking=blocking),
+        registry.get(Light, 'entry_roof_2').set_state(on, brightness=brightess, blocking=blocking),
+        registry.get(Outlet, 'entrylight').set_state(on, blocking=blocking)
     )
 
-async def set_secondaryentry_lights(registry, on=True, brightess=None):
-    await registry.get(Light, 'secondaryentry_roof').set_state(on, brightness=brightess),
\ No newline at end of file
+async def set_secondaryentry_lights(registry, on=True, brightess=None, blocking=True):
+    return [await registry.get(Light, 'secondaryentry_roof').set_state(on, brightness=brightess, blocking=blocking)]
\ No newline at end of file